@@ -1,22 +1,33 @@
 #bling_stock.py
+import asyncio
 import logging
+import sys
+import time
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from whatsapp_client import create_whatsapp_client, MessageType
-import json
+import orjson
+import numpy as np
+from bisect import bisect_left
+from urllib.parse import parse_qs
+
+# Aho-Corasick (extensão C) é o caminho rápido para detectar relações
+# pai-filho; sem ele, caímos no scan ordenado por tamanho de nome
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 from fastapi import FastAPI, Request
 import os
-from stock_agent import StockAgent
+import httpx
 from fastapi import Depends, HTTPException, Header
 from stock_agent import StockAgent
+from token_manager import BlingTokenManager
 
 
-# Configuração do sistema de logs
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# A configuração de logging (basicConfig) fica por conta do main.py;
+# configurar aqui de novo só duplicava handler na raiz
 logger = logging.getLogger(__name__)
 
 # Classes de configuração usando dataclass para melhor organização
@@ -35,11 +46,57 @@ class WhatsAppGroup:
 # Inicialização do FastAPI para receber webhooks
 app = FastAPI()
 
+@app.on_event("startup")
+async def _criar_http_compartilhado():
+    """
+    Cria um único httpx.AsyncClient para o processo: um pool keep-alive,
+    um cache de DNS e uma sessão TLS compartilhados por todos os serviços,
+    em vez de cada componente manter o seu
+    """
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
+    # O gerenciador de token (singleton) passa a usar o mesmo pool
+    if BlingTokenManager._instance is not None:
+        BlingTokenManager._instance.adopt_http_client(app.state.http)
+
+@app.on_event("shutdown")
+async def _fechar_http_compartilhado():
+    """Fecha os clientes HTTP compartilhados no shutdown do app"""
+    await app.state.http.aclose()
+    # O agente de estoque (se inicializado) mantém o próprio pool com o Bling
+    if stock_agent is not None:
+        await stock_agent.bling_tool.aclose()
+
 # Variáveis globais para acesso aos componentes nos endpoints
 bling_monitor = None
 stock_agent = None
 
+# A partir de quantas linhas (codigo, deposito) vale a pena vetorizar a
+# checagem de saldo com NumPy; abaixo disso o overhead de montar os arrays
+# supera o ganho
+NUMPY_MIN_ROWS = 512
+
+# Separadores descartados do início do nome da variação (ex.: "Camiseta - P")
+_VAR_STRIP = ":-/ ,\t"
+
+# Janela de coalescência dos alertas (segundos): webhooks que chegarem
+# dentro dela viram uma única mensagem no WhatsApp
+ALERT_FLUSH_WINDOW = 5.0
+
 class BlingStockMonitor:
+    # Cabeçalho e rodapé constantes do alerta: montados uma vez na classe,
+    # só o horário é interpolado na hora do envio
+    _ALERT_HEADER = (
+        "🚨 *ALERTA DE ESTOQUE - {hora}* \n\n"
+        "Produtos com estoque zerado ou negativo:\n"
+    )
+    _ALERT_FOOTER = (
+        "\nℹ️ _Este é um alerta automático do sistema de monitoramento._\n"
+        "_Verifique e atualize os estoques conforme necessário._"
+    )
+
     def __init__(
         self,
         bling_config: BlingConfig,
@@ -55,139 +112,259 @@ class BlingStockMonitor:
         self.bling_config = bling_config
         self.whatsapp_client = create_whatsapp_client(**whatsapp_config)
         self.whatsapp_group = whatsapp_group
-        self.last_alerts = {}  # Armazena o último alerta enviado para cada produto
+        self.last_alerts = {}  # Dia (ordinal) do último alerta enviado para cada produto
+        self._last_purge_ord = 0  # Dia da última poda do last_alerts
         self._last_data = None  # Para armazenar os últimos dados recebidos
+        self._familias_cache = None  # (hash dos nomes, relacoes_pai_filho, filhos_para_pais)
+        self._payload_cache = None  # (assinatura, produtos_mapeados, relacoes, filhos, saldos, zerados)
+        # Fila de coalescência: webhooks quase simultâneos (Full + Principal)
+        # viram um único envio ao WhatsApp. Já agrupada por depósito para o
+        # formatador não precisar re-bucketar os alertas
+        self._pending_alerts: Dict[str, List[Dict]] = {}
+        self._pending_filhos: Dict[str, str] = {}
+        self._flush_task = None
         logger.info(f"Monitor de estoque inicializado para o grupo: {self.whatsapp_group.name}")
         logger.info(f"ID do Grupo: {self.whatsapp_group.group_id}")
-        
-    def format_alert_message(self, alerts: List[Dict]) -> str:
+
+    def _build_relacoes(self, produtos_mapeados: Dict[str, Dict]) -> Tuple[Dict[str, list], Dict[str, str]]:
+        """
+        Identifica relações pai-filho entre produtos usando Aho-Corasick.
+        Uma única passada O(soma dos tamanhos dos nomes + matches) substitui
+        o scan O(N²) de substrings em Python puro.
+        :param produtos_mapeados: Mapa codigo -> produto
+        :return: Tupla (relacoes_pai_filho, filhos_para_pais)
+        """
+        if ahocorasick is None:
+            return self._build_relacoes_ordenado(produtos_mapeados)
+
+        relacoes_pai_filho = {}
+        filhos_para_pais = {}
+
+        # Monta o autômato com todos os nomes de produto
+        automaton = ahocorasick.Automaton()
+        for codigo, produto in produtos_mapeados.items():
+            nome = produto.get('nome', '')
+            if nome:
+                automaton.add_word(nome, (codigo, nome))
+
+        if len(automaton) == 0:
+            return relacoes_pai_filho, filhos_para_pais
+
+        automaton.make_automaton()
+
+        # Para cada produto, procura nomes de outros produtos contidos no dele
+        for codigo_filho, produto_filho in produtos_mapeados.items():
+            nome_filho = produto_filho.get('nome', '')
+            if not nome_filho:
+                continue
+
+            melhor_pai = None
+            melhor_tamanho = 0
+            for _, (codigo_pai, nome_pai) in automaton.iter(nome_filho):
+                # Pule o mesmo produto
+                if codigo_pai == codigo_filho:
+                    continue
+
+                # Mesmo critério do scan original: o nome do filho contém o
+                # nome do pai e é mais longo (com margem de 3 caracteres).
+                # Fica com o match mais longo como pai.
+                if (len(nome_filho) > len(nome_pai) + 3 and
+                        len(nome_pai) > melhor_tamanho):
+                    melhor_pai = codigo_pai
+                    melhor_tamanho = len(nome_pai)
+
+            if melhor_pai:
+                if melhor_pai not in relacoes_pai_filho:
+                    relacoes_pai_filho[melhor_pai] = []
+                relacoes_pai_filho[melhor_pai].append(codigo_filho)
+                filhos_para_pais[codigo_filho] = melhor_pai
+
+        return relacoes_pai_filho, filhos_para_pais
+
+    def _build_relacoes_ordenado(self, produtos_mapeados: Dict[str, Dict]) -> Tuple[Dict[str, list], Dict[str, str]]:
+        """
+        Fallback sem Aho-Corasick: ordena os nomes por tamanho e, para cada
+        filho, só compara contra os nomes curtos o bastante para serem pai
+        (corte via busca binária), varrendo do mais longo para o mais curto
+        para achar o melhor pai primeiro.
+        :param produtos_mapeados: Mapa codigo -> produto
+        :return: Tupla (relacoes_pai_filho, filhos_para_pais)
+        """
+        relacoes_pai_filho = {}
+        filhos_para_pais = {}
+
+        entradas = sorted(
+            ((p.get('nome', ''), codigo) for codigo, p in produtos_mapeados.items()
+             if p.get('nome', '')),
+            key=lambda e: len(e[0])
+        )
+        tamanhos = [len(nome) for nome, _ in entradas]
+
+        for nome_filho, codigo_filho in entradas:
+            # Só nomes com pelo menos 4 caracteres a menos podem ser pai
+            limite = bisect_left(tamanhos, len(nome_filho) - 3)
+
+            for indice in range(limite - 1, -1, -1):
+                nome_pai, codigo_pai = entradas[indice]
+                if codigo_pai == codigo_filho:
+                    continue
+                if nome_pai in nome_filho:
+                    # Primeiro match varrendo do mais longo = melhor pai
+                    if codigo_pai not in relacoes_pai_filho:
+                        relacoes_pai_filho[codigo_pai] = []
+                    relacoes_pai_filho[codigo_pai].append(codigo_filho)
+                    filhos_para_pais[codigo_filho] = codigo_pai
+                    break
+
+        return relacoes_pai_filho, filhos_para_pais
+
+    def _relacoes_cacheadas(self, produtos_mapeados: Dict[str, Dict]) -> Tuple[Dict[str, list], Dict[str, str]]:
+        """
+        Versão memoizada de _build_relacoes: webhooks repetidos com o mesmo
+        catálogo de nomes reaproveitam as relações já calculadas e pulam a
+        construção do autômato.
+        :param produtos_mapeados: Mapa codigo -> produto
+        :return: Tupla (relacoes_pai_filho, filhos_para_pais)
+        """
+        chave = hash(frozenset(
+            p.get('nome', '') for p in produtos_mapeados.values()
+        ))
+
+        if self._familias_cache and self._familias_cache[0] == chave:
+            return self._familias_cache[1], self._familias_cache[2]
+
+        relacoes_pai_filho, filhos_para_pais = self._build_relacoes(produtos_mapeados)
+        self._familias_cache = (chave, relacoes_pai_filho, filhos_para_pais)
+        return relacoes_pai_filho, filhos_para_pais
+
+    def format_alert_message(self, depositos: Dict[str, List[Dict]],
+                             filhos_para_pais: Optional[Dict[str, str]] = None) -> str:
         """
         Formata a mensagem de alerta para envio no WhatsApp com formato melhorado
-        :param alerts: Lista de alertas a serem formatados
+        :param depositos: Alertas já agrupados por depósito pelo handle_webhook
+        :param filhos_para_pais: Mapa filho -> pai já calculado pelo handle_webhook (opcional)
         :return: Mensagem formatada
         """
-        current_time = datetime.now().strftime("%d/%m/%Y %H:%M")
-        
-        message = (
-            f"🚨 *ALERTA DE ESTOQUE - {current_time}* \n\n"
-            f"Produtos com estoque zerado ou negativo:\n"
-        )
+        # time.strftime formata direto do relógio, sem alocar um datetime
+        current_time = time.strftime("%d/%m/%Y %H:%M")
 
-        # Organiza alertas por depósito
-        depositos = {"Depósito Full": [], "Depósito Principal": []}
-        for alert in alerts:
-            depositos[alert['deposito']].append(alert)
+        # Monta a mensagem em uma lista e junta uma única vez no final:
+        # montagem linear em vez de realocar a string a cada +=
+        parts: List[str] = [self._ALERT_HEADER.format(hora=current_time)]
 
-        # Para cada depósito
+        # Para cada depósito (os alertas chegam agrupados, sem segunda passada)
         for deposito_nome, produtos in depositos.items():
             if not produtos:
                 continue
-                
-            message += f"\n🏪 *{deposito_nome}*\n"
-            
+
+            parts.append(f"\n🏪 *{deposito_nome}*\n")
+
             # Crie um mapa de produtos pai -> [variações]
             familias_produtos = {}
             produtos_processados = set()
-            
-            # Etapa 1: Identificar todos os produtos pai
-            pais_encontrados = set()
+
+            # Índice codigo -> alerta deste depósito
+            produtos_por_codigo = {
+                p['codigo']: p for p in produtos if p.get('codigo')
+            }
+
+            # Reaproveita as relações já calculadas pelo handle_webhook; se a
+            # mensagem for formatada avulsa, usa a versão memoizada
+            if filhos_para_pais is None:
+                _, filhos_para_pais = self._relacoes_cacheadas(produtos_por_codigo)
+
+            # Uma única passada: agrupa cada alerta pela família do seu pai
             for produto in produtos:
                 codigo = produto.get('codigo', '')
-                nome = produto.get('nome', '')
-                
-                # Verifica se este produto é pai de algum outro
-                for outro_produto in produtos:
-                    outro_codigo = outro_produto.get('codigo', '')
-                    outro_nome = outro_produto.get('nome', '')
-                    
-                    # Se outro produto tem o nome deste + algo a mais, este é um pai
-                    if (nome and outro_nome and 
-                        nome != outro_nome and 
-                        nome in outro_nome and
-                        len(outro_nome) > len(nome) + 3):
-                        pais_encontrados.add(codigo)
-                        break
-            
-            # Etapa 2: Agrupar variações com seus pais
-            for pai_codigo in pais_encontrados:
-                familias_produtos[pai_codigo] = []
-                
-                # Encontrar o produto pai nos dados
-                pai_produto = None
-                for produto in produtos:
-                    if produto.get('codigo', '') == pai_codigo:
-                        pai_produto = produto
+                pai_codigo = filhos_para_pais.get(codigo)
+
+                # Só agrupa se o pai também está entre os alertas deste depósito
+                if pai_codigo and pai_codigo in produtos_por_codigo:
+                    if pai_codigo not in familias_produtos:
+                        familias_produtos[pai_codigo] = []
                         produtos_processados.add(pai_codigo)
-                        break
-                
-                # Encontrar todas as variações deste pai
-                for produto in produtos:
-                    codigo = produto.get('codigo', '')
-                    nome = produto.get('nome', '')
-                    pai_nome = pai_produto.get('nome', '') if pai_produto else ''
-                    
-                    # Se não é o próprio pai e contém o nome do pai, é uma variação
-                    if (codigo != pai_codigo and pai_nome and 
-                        pai_nome in nome and len(nome) > len(pai_nome)):
-                        familias_produtos[pai_codigo].append(produto)
-                        produtos_processados.add(codigo)
-            
+                    familias_produtos[pai_codigo].append(produto)
+                    produtos_processados.add(codigo)
+
             # Etapa 3: Formatar a mensagem com produtos pai e suas variações
             for pai_codigo, variacoes in familias_produtos.items():
-                # Encontrar o produto pai
-                pai_produto = None
-                for produto in produtos:
-                    if produto.get('codigo', '') == pai_codigo:
-                        pai_produto = produto
-                        break
-                
+                pai_produto = produtos_por_codigo.get(pai_codigo)
+
                 if pai_produto:
-                    message += f"\n📦 *{pai_produto.get('nome', '')}*\n(SKU PAI: {pai_produto.get('codigo', 'N/A')})\n\n"
+                    parts.append(f"\n📦 *{pai_produto.get('nome', '')}*\n(SKU PAI: {pai_produto.get('codigo', 'N/A')})\n\n")
                     
                     if variacoes:
-                        message += f"   *Variações com estoque zerado:* ⚠️\n"
+                        parts.append("   *Variações com estoque zerado:* ⚠️\n")
                         for i, variacao in enumerate(variacoes, 1):
                             # Extrair apenas a parte da variação
+                            # removeprefix só corta o pai do início do nome,
+                            # sem varrer a string inteira como o replace fazia
                             nome_completo = variacao.get('nome', '')
                             nome_pai = pai_produto.get('nome', '')
-                            nome_variacao = nome_completo.replace(nome_pai, '').strip()
-                            
-                            # Limpar possíveis separadores no início
-                            for sep in [':', ' ', '-', '/', ',']: 
-                                if nome_variacao.startswith(sep):
-                                    nome_variacao = nome_variacao[1:].strip()
-                                    break
-                                    
-                            message += f"   • {nome_variacao} (SKU: {variacao.get('codigo', 'N/A')})\n"
+                            nome_variacao = nome_completo.removeprefix(nome_pai).strip()
+
+                            # Limpar possíveis separadores no início (um único
+                            # lstrip em C em vez da cascata de startswith)
+                            nome_variacao = nome_variacao.lstrip(_VAR_STRIP)
+
+                            parts.append(f"   • {nome_variacao} (SKU: {variacao.get('codigo', 'N/A')})\n")
                     
-                    message += "\n"
+                    parts.append("\n")
             
             # Etapa 4: Listar produtos que não são pai nem variações
             for produto in produtos:
                 codigo = produto.get('codigo', '')
                 if codigo not in produtos_processados:
-                    message += f"\n📦 *{produto.get('nome', '')}*\n"
-                    message += f"   SKU: {produto.get('codigo', 'N/A')}\n"
-                    message += f"   Estoque: {produto.get('estoque_atual', 0)}\n"
+                    parts.append(f"\n📦 *{produto.get('nome', '')}*\n")
+                    parts.append(f"   SKU: {produto.get('codigo', 'N/A')}\n")
+                    parts.append(f"   Estoque: {produto.get('estoque_atual', 0)}\n")
                     
-        message += (
-            "\nℹ️ _Este é um alerta automático do sistema de monitoramento._\n"
-            "_Verifique e atualize os estoques conforme necessário._"
-        )
+        parts.append(self._ALERT_FOOTER)
 
-        return message
+        return "".join(parts)
 
-    async def send_group_alert(self, alerts: List[Dict]) -> bool:
+    async def send_group_alert(self, deposito: str, alerts: List[Dict],
+                               filhos_para_pais: Optional[Dict[str, str]] = None) -> bool:
         """
         Envia alerta para o grupo do WhatsApp
+        :param deposito: Nome do depósito de onde vieram os alertas
         :param alerts: Lista de alertas a serem enviados
+        :param filhos_para_pais: Mapa filho -> pai já calculado (opcional)
         :return: True se enviado com sucesso, False caso contrário
         """
         if not alerts:
             return True
 
-        message = self.format_alert_message(alerts)
-        
+        # Acumula os alertas já agrupados por depósito e agenda um único
+        # flush; chamadas que chegarem dentro da janela pegam carona no envio
+        self._pending_alerts.setdefault(deposito, []).extend(alerts)
+        if filhos_para_pais:
+            self._pending_filhos.update(filhos_para_pais)
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(
+                self._flush_alerts_after(ALERT_FLUSH_WINDOW)
+            )
+
+        return True
+
+    async def _flush_alerts_after(self, delay: float) -> bool:
+        """
+        Aguarda a janela de coalescência e envia todos os alertas pendentes
+        em uma única mensagem para o grupo
+        :param delay: Janela de espera em segundos
+        :return: True se enviado com sucesso, False caso contrário
+        """
+        await asyncio.sleep(delay)
+
+        depositos, self._pending_alerts = self._pending_alerts, {}
+        filhos_para_pais, self._pending_filhos = self._pending_filhos, {}
+
+        if not depositos:
+            return True
+
+        message = self.format_alert_message(depositos, filhos_para_pais or None)
+
         try:
             success = await self.whatsapp_client.send_message(
                 text=message,
@@ -197,14 +374,14 @@ class BlingStockMonitor:
                 delay=1000,
                 metadata={"isGroup": True}
             )
-            
+
             if success:
                 logger.info(f"Alerta enviado com sucesso para o grupo: {self.whatsapp_group.name}")
             else:
                 logger.error(f"Falha ao enviar alerta para o grupo: {self.whatsapp_group.name}")
-            
+
             return success
-            
+
         except Exception as e:
             logger.error(f"Erro ao enviar alerta para o grupo: {e}")
             return False
@@ -212,60 +389,123 @@ class BlingStockMonitor:
     async def handle_webhook(self, data: dict, deposito: str):
         try:
             logger.info(f"Webhook recebido para {deposito}")
-            
+
+            # Relógio lido uma única vez por webhook: evita uma syscall por
+            # produto/alerta no loop abaixo
+            now = datetime.now()
+
+            # Dia atual como inteiro: a checagem de duplicata vira uma
+            # comparação de ints em vez de aritmética de datetime por alerta
+            today_ord = now.toordinal()
+
+            # Na virada do dia, descarta as entradas antigas: o dict fica
+            # limitado aos alertas de hoje em vez de crescer para sempre
+            if self._last_purge_ord != today_ord:
+                self.last_alerts = {
+                    k: v for k, v in self.last_alerts.items() if v >= today_ord
+                }
+                self._last_purge_ord = today_ord
+
+
             if 'retorno' not in data or 'estoques' not in data['retorno']:
                 logger.warning(f"Formato de dados inválido: campos 'retorno' ou 'estoques' ausentes")
                 return {"status": "warning", "message": "Formato de dados inválido"}
             
             estoques_list = data['retorno']['estoques']
-            
+
             # Armazena os dados mais recentes para referência
             self._last_data = data
+
+            # Saída antecipada: ignora o payload inteiro se nenhum produto tem
+            # depósito considerado, sem montar mapa ou relações
+            # 'in' + indexação direta e default de tupla vazia: o encadeado
+            # .get('deposito', {}) alocava um dict descartável por linha
+            estoques_list = [
+                w for w in estoques_list
+                if 'estoque' in w and any(
+                    d['deposito'].get('desconsiderar', 'N') == 'N'
+                    for d in w['estoque'].get('depositos', ())
+                    if 'deposito' in d
+                )
+            ]
+            if not estoques_list:
+                logger.info(f"Nenhum produto acionável no payload para {deposito}")
+                return {"status": "success", "message": "Nenhum alerta necessário"}
             
-            # Primeiro passo: mapear todos os produtos e identificar relações pai-filho
-            produtos_mapeados = {}
-            relacoes_pai_filho = {}
-            filhos_para_pais = {}
-            
-            # Mapear todos os produtos
-            for produto_wrapper in estoques_list:
-                if 'estoque' not in produto_wrapper:
-                    continue
-                    
-                produto = produto_wrapper['estoque']
-                codigo = produto.get('codigo', '')
-                nome = produto.get('nome', '')
-                
-                if codigo and nome:
-                    produtos_mapeados[codigo] = produto
-            
-            # Identificar relações pai-filho
-            for codigo_filho, produto_filho in produtos_mapeados.items():
-                nome_filho = produto_filho.get('nome', '')
-                
-                for codigo_pai, produto_pai in produtos_mapeados.items():
-                    # Pule o mesmo produto
-                    if codigo_pai == codigo_filho:
+            # Assinatura do payload: o Bling costuma repostar o mesmo estado de
+            # catálogo; se for idêntico ao anterior, reaproveita as estruturas
+            # já montadas e pula direto para a decisão de alertas
+            sig = hash(orjson.dumps(estoques_list, option=orjson.OPT_SORT_KEYS))
+
+            if self._payload_cache and self._payload_cache[0] == sig:
+                (_, produtos_mapeados, relacoes_pai_filho,
+                 filhos_para_pais, saldos, zerados) = self._payload_cache
+            else:
+                # Primeiro passo: mapear todos os produtos e identificar relações pai-filho
+                produtos_mapeados = {}
+
+                # Mapear todos os produtos
+                for produto_wrapper in estoques_list:
+                    if 'estoque' not in produto_wrapper:
                         continue
-                        
-                    nome_pai = produto_pai.get('nome', '')
-                    
-                    # Se o nome do filho contém o nome do pai e é mais longo
-                    if (nome_pai and nome_filho and nome_pai in nome_filho and 
-                        nome_filho != nome_pai and len(nome_filho) > len(nome_pai) + 3):
-                        
-                        # Registra relação
-                        if codigo_pai not in relacoes_pai_filho:
-                            relacoes_pai_filho[codigo_pai] = []
-                        
-                        relacoes_pai_filho[codigo_pai].append(codigo_filho)
-                        filhos_para_pais[codigo_filho] = codigo_pai
-                        break
-            
+
+                    produto = produto_wrapper['estoque']
+                    # Interna códigos e nomes: chaves de dict/set passam a comparar
+                    # por ponteiro durante hashing e membership
+                    codigo = sys.intern(produto.get('codigo', ''))
+                    nome = sys.intern(produto.get('nome', ''))
+
+                    if codigo and nome:
+                        produtos_mapeados[codigo] = produto
+
+                # Identificar relações pai-filho em uma única passada (Aho-Corasick,
+                # memoizada entre webhooks com o mesmo catálogo)
+                relacoes_pai_filho, filhos_para_pais = self._relacoes_cacheadas(produtos_mapeados)
+
+                # Índice plano (codigo, deposito) -> (saldo, desconsiderar) para
+                # consultas O(1) em vez de varrer a lista de depósitos de cada filho
+                saldos = {}
+                for codigo_prod, produto_prod in produtos_mapeados.items():
+                    for dep_wrapper in produto_prod.get('depositos', ()):
+                        if 'deposito' not in dep_wrapper:
+                            continue
+                        dep = dep_wrapper['deposito']
+                        saldos[(codigo_prod, dep.get('nome', ''))] = (
+                            float(dep.get('saldo', 0)),
+                            dep.get('desconsiderar', 'N')
+                        )
+
+                # Para payloads grandes, pré-filtra com NumPy quais pares
+                # (codigo, deposito) estão zerados e considerados: uma
+                # comparação vetorizada substitui o branch Python por linha
+                zerados = None
+                if len(saldos) >= NUMPY_MIN_ROWS:
+                    chaves = list(saldos.keys())
+                    valores = np.fromiter(
+                        (v[0] for v in saldos.values()),
+                        dtype=np.float32, count=len(saldos)
+                    )
+                    considerados = np.fromiter(
+                        (v[1] == 'N' for v in saldos.values()),
+                        dtype=bool, count=len(saldos)
+                    )
+                    alert_mask = (valores <= 0) & considerados
+                    zerados = {chaves[i] for i in np.flatnonzero(alert_mask)}
+
+                self._payload_cache = (sig, produtos_mapeados, relacoes_pai_filho,
+                                       filhos_para_pais, saldos, zerados)
+
             # Segundo passo: verificar estoques e criar alertas
             alerts = []
             processed_codes = set()
-            
+
+            # Liga os nomes quentes a locais: LOAD_FAST em vez de
+            # LOAD_GLOBAL/LOAD_ATTR a cada linha do loop abaixo
+            _float = float
+            last_alerts = self.last_alerts
+            saldos_get = saldos.get
+            debug_on = logger.isEnabledFor(logging.DEBUG)
+
             for produto_wrapper in estoques_list:
                 if 'estoque' not in produto_wrapper:
                     continue
@@ -279,48 +519,47 @@ class BlingStockMonitor:
                     continue
                     
                 estoque_atual = produto.get('estoqueAtual', 0)
-                logger.info(f"Processando produto: {nome} ({codigo}) - Estoque total: {estoque_atual}")
+                if debug_on:
+                    logger.debug(f"Processando produto: {nome} ({codigo}) - Estoque total: {estoque_atual}")
                 
                 # Processa depósitos
-                depositos_prod = produto.get('depositos', [])
+                depositos_prod = produto.get('depositos', ())
                 for dep_wrapper in depositos_prod:
                     if 'deposito' not in dep_wrapper:
                         continue
                         
                     dep = dep_wrapper['deposito']
                     dep_nome = dep.get('nome', '')
-                    dep_saldo = float(dep.get('saldo', 0))
+
+                    # Payload grande: o pré-filtro vetorizado já decidiu quais
+                    # pares estão zerados e considerados; pula os demais sem
+                    # refazer float() e comparações por linha
+                    if zerados is not None and (codigo, dep_nome) not in zerados:
+                        continue
+
+                    dep_saldo = _float(dep.get('saldo', 0))
                     dep_desconsiderar = dep.get('desconsiderar', 'N')
-                    
+
                     if dep_desconsiderar == 'S':
-                        logger.info(f"Depósito {dep_nome} ignorado (desconsiderar=S)")
+                        if debug_on:
+                            logger.debug(f"Depósito {dep_nome} ignorado (desconsiderar=S)")
                         continue
-                    
-                    logger.info(f"Produto {codigo} - Depósito: {dep_nome} - Estoque: {dep_saldo}")
+
+                    if debug_on:
+                        logger.debug(f"Produto {codigo} - Depósito: {dep_nome} - Estoque: {dep_saldo}")
                     
                     # Verifica se é um produto pai com variações
                     e_pai_com_variacoes = codigo in relacoes_pai_filho and len(relacoes_pai_filho[codigo]) > 0
                     
-                    # Verifica se o produto pai tem pelo menos uma variação com estoque
+                    # Verifica se o produto pai tem pelo menos uma variação com
+                    # estoque neste depósito (lookup O(1) no índice de saldos)
                     tem_variacao_com_estoque = False
                     if e_pai_com_variacoes:
-                        for codigo_filho in relacoes_pai_filho[codigo]:
-                            produto_filho = produtos_mapeados.get(codigo_filho)
-                            if not produto_filho:
-                                continue
-                                
-                            for dep_filho_wrapper in produto_filho.get('depositos', []):
-                                if 'deposito' not in dep_filho_wrapper:
-                                    continue
-                                    
-                                dep_filho = dep_filho_wrapper['deposito']
-                                if dep_filho.get('nome') == dep_nome and dep_filho.get('desconsiderar') == 'N':
-                                    if float(dep_filho.get('saldo', 0)) > 0:
-                                        tem_variacao_com_estoque = True
-                                        break
-                            
-                            if tem_variacao_com_estoque:
-                                break
+                        tem_variacao_com_estoque = any(
+                            saldos_get((codigo_filho, dep_nome), (0.0, 'N'))[0] > 0
+                            and saldos[(codigo_filho, dep_nome)][1] == 'N'
+                            for codigo_filho in relacoes_pai_filho[codigo]
+                        )
                     
                     # Se é pai com variações e pelo menos uma tem estoque, não alerta sobre o pai
                     if e_pai_com_variacoes and tem_variacao_com_estoque and dep_saldo <= 0:
@@ -330,21 +569,22 @@ class BlingStockMonitor:
                     # Se o produto é filho, sempre alerta se estoque <= 0
                     # Se é pai sem variações com estoque, também alerta
                     if dep_saldo <= 0:
+                        # O depósito já identifica o grupo inteiro de alertas
+                        # deste webhook; não precisa repetir em cada dict
                         alert = {
                             'codigo': codigo,
                             'nome': nome,
-                            'deposito': deposito,
                             'estoque_atual': dep_saldo,
-                            'timestamp': datetime.now()
+                            'timestamp': now
                         }
                         
-                        # Verifica duplicatas no mesmo dia
-                        alert_key = f"{codigo}_{deposito}"
-                        last_alert = self.last_alerts.get(alert_key)
-                        
-                        if not last_alert or (datetime.now() - last_alert).days >= 1:
+                        # Verifica duplicatas no mesmo dia (comparação de ints);
+                        # tupla evita alocar uma string concatenada por produto
+                        alert_key = (codigo, deposito)
+
+                        if last_alerts.get(alert_key, 0) < today_ord:
                             alerts.append(alert)
-                            self.last_alerts[alert_key] = datetime.now()
+                            last_alerts[alert_key] = today_ord
                             logger.info(f"Alerta necessário para {codigo} em {deposito}")
                         else:
                             logger.info(f"Alerta ignorado (já enviado hoje) para {codigo} em {deposito}")
@@ -352,7 +592,7 @@ class BlingStockMonitor:
                 processed_codes.add(codigo)
             
             if alerts:
-                await self.send_group_alert(alerts)
+                await self.send_group_alert(deposito, alerts, filhos_para_pais)
                 logger.info(f"Alerta via webhook processado para {deposito}: {len(alerts)} produtos")
                 return {"status": "success", "message": "Alerta enviado", "count": len(alerts)}
             else:
@@ -360,9 +600,9 @@ class BlingStockMonitor:
                 return {"status": "success", "message": "Nenhum alerta necessário"}
                 
         except Exception as e:
-            logger.error(f"Erro ao processar webhook para {deposito}: {e}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
+            # logger.exception já anexa o traceback, sem importar traceback
+            # nem formatar a string no caminho do erro
+            logger.exception(f"Erro ao processar webhook para {deposito}: {e}")
             return {"status": "error", "message": str(e)}
 
 # Endpoint para verificar o status do servidor
@@ -379,100 +619,92 @@ async def root():
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
 
+# Limite de tamanho do corpo aceito nos webhooks (10 MB)
+MAX_WEBHOOK_BODY = 10 * 1024 * 1024
+
+async def _parse_bling_payload(request: Request):
+    """
+    Lê e decodifica o corpo de um webhook do Bling (JSON ou form-urlencoded).
+    Lê o corpo uma única vez e usa parse_qs em vez de request.form(), que
+    materializaria um FormData completo.
+    :param request: Requisição recebida
+    :return: Tupla (data, erro) - 'erro' é um dict de resposta ou None
+    """
+    content_type = request.headers.get("content-type", "")
+    logger.info(f"Content-Type: {content_type}")
+
+    body = await request.body()
+
+    if len(body) > MAX_WEBHOOK_BODY:
+        logger.warning(f"Corpo do webhook excede o limite: {len(body)} bytes")
+        return None, {"status": "error", "message": "Corpo da requisição muito grande"}
+
+    if "application/x-www-form-urlencoded" in content_type:
+        # Processa form data sem materializar um FormData completo
+        form_data = parse_qs(body.decode('utf-8', errors='replace'), max_num_fields=100)
+        json_values = form_data.get("data")
+
+        if not json_values:
+            logger.warning("Parâmetro 'data' não encontrado no form")
+            return None, {"status": "error", "message": "Parâmetro 'data' não encontrado"}
+
+        try:
+            data = orjson.loads(json_values[0])
+            logger.info(f"JSON decodificado com sucesso do parâmetro 'data'")
+        except orjson.JSONDecodeError as e:
+            logger.error(f"Erro ao decodificar JSON do parâmetro 'data': {e}")
+            return None, {"status": "error", "message": f"JSON inválido no parâmetro 'data': {str(e)}"}
+    else:
+        # Tenta como JSON padrão
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            logger.error(f"Erro ao decodificar JSON: {e}")
+            body_text = body.decode('utf-8', errors='replace')
+            logger.info(f"Corpo da requisição bruto: '{body_text}'")
+            return None, {"status": "error", "message": f"JSON inválido: {str(e)}"}
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Dados processados: {orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()}")
+
+    return data, None
+
 # Endpoints para receber webhooks do Bling
-@app.post("/full")
-async def bling_webhook_full(request: Request):
-    """Endpoint para receber webhooks do Bling para o Depósito Full"""
-    if not bling_monitor:
-        logger.error("Monitor não inicializado")
-        return {"status": "error", "message": "Monitor não inicializado"}
-    
-    try:
-        # Verifica o content-type
-        content_type = request.headers.get("content-type", "")
-        logger.info(f"Content-Type: {content_type}")
-        
-        if "application/x-www-form-urlencoded" in content_type:
-            # Processa form data
-            form_data = await request.form()
-            json_data = form_data.get("data")
-            
-            if not json_data:
-                logger.warning("Parâmetro 'data' não encontrado no form")
-                return {"status": "error", "message": "Parâmetro 'data' não encontrado"}
-            
-            try:
-                data = json.loads(json_data)
-                logger.info(f"JSON decodificado com sucesso do parâmetro 'data'")
-            except json.JSONDecodeError as e:
-                logger.error(f"Erro ao decodificar JSON do parâmetro 'data': {e}")
-                return {"status": "error", "message": f"JSON inválido no parâmetro 'data': {str(e)}"}
-        else:
-            # Tenta como JSON padrão
-            try:
-                data = await request.json()
-            except json.JSONDecodeError as e:
-                logger.error(f"Erro ao decodificar JSON: {e}")
-                body = await request.body()
-                body_text = body.decode('utf-8', errors='replace')
-                logger.info(f"Corpo da requisição bruto: '{body_text}'")
-                return {"status": "error", "message": f"JSON inválido: {str(e)}"}
-        
-        logger.info(f"Dados processados: {json.dumps(data, indent=2)}")
-        result = await bling_monitor.handle_webhook(data, "Depósito Full")
-        return result
-    except Exception as e:
-        logger.error(f"Erro ao processar webhook: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return {"status": "error", "message": f"Erro interno: {str(e)}"}
-
-@app.post("/principal")
-async def bling_webhook_principal(request: Request):
-    """Endpoint para receber webhooks do Bling para o Depósito Principal"""
-    if not bling_monitor:
-        logger.error("Monitor não inicializado")
-        return {"status": "error", "message": "Monitor não inicializado"}
-    
-    try:
-        # Verifica o content-type
-        content_type = request.headers.get("content-type", "")
-        logger.info(f"Content-Type: {content_type}")
-        
-        if "application/x-www-form-urlencoded" in content_type:
-            # Processa form data
-            form_data = await request.form()
-            json_data = form_data.get("data")
-            
-            if not json_data:
-                logger.warning("Parâmetro 'data' não encontrado no form")
-                return {"status": "error", "message": "Parâmetro 'data' não encontrado"}
-            
-            try:
-                data = json.loads(json_data)
-                logger.info(f"JSON decodificado com sucesso do parâmetro 'data'")
-            except json.JSONDecodeError as e:
-                logger.error(f"Erro ao decodificar JSON do parâmetro 'data': {e}")
-                return {"status": "error", "message": f"JSON inválido no parâmetro 'data': {str(e)}"}
-        else:
-            # Tenta como JSON padrão
-            try:
-                data = await request.json()
-            except json.JSONDecodeError as e:
-                logger.error(f"Erro ao decodificar JSON: {e}")
-                body = await request.body()
-                body_text = body.decode('utf-8', errors='replace')
-                logger.info(f"Corpo da requisição bruto: '{body_text}'")
-                return {"status": "error", "message": f"JSON inválido: {str(e)}"}
-        
-        logger.info(f"Dados processados: {json.dumps(data, indent=2)}")
-        result = await bling_monitor.handle_webhook(data, "Depósito Principal")
-        return result
-    except Exception as e:
-        logger.error(f"Erro ao processar webhook: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return {"status": "error", "message": f"Erro interno: {str(e)}"}
+def make_bling_endpoint(deposito_label: str):
+    """
+    Fábrica dos endpoints de webhook do Bling: /full e /principal só diferem
+    no rótulo do depósito, então o handler é gerado uma vez com o rótulo
+    capturado na closure em vez de duplicar o corpo inteiro.
+    :param deposito_label: Nome do depósito passado ao handle_webhook
+    :return: Handler async pronto para registrar no app
+    """
+    async def bling_webhook(request: Request):
+        if not bling_monitor:
+            logger.error("Monitor não inicializado")
+            return {"status": "error", "message": "Monitor não inicializado"}
+
+        try:
+            data, erro = await _parse_bling_payload(request)
+            if erro:
+                return erro
+
+            result = await bling_monitor.handle_webhook(data, deposito_label)
+            return result
+        except Exception as e:
+            logger.exception(f"Erro ao processar webhook: {e}")
+            return {"status": "error", "message": f"Erro interno: {str(e)}"}
+
+    return bling_webhook
+
+# Tabela rota -> nome do depósito: fonte única dos rótulos usados nos
+# alertas, em vez de espalhar as strings pelos registros de endpoint
+DEPOSITOS_POR_ROTA = {
+    "/full": "Depósito Full",
+    "/principal": "Depósito Principal",
+}
+
+for _rota, _rotulo in DEPOSITOS_POR_ROTA.items():
+    app.post(_rota)(make_bling_endpoint(_rotulo))
 
 def initialize_monitor(monitor):
     """Inicializa o monitor global para o webhook"""
@@ -500,8 +732,9 @@ async def webhook_handler(request: Request):
             return {"status": "error", "message": "Agente de estoque não inicializado"}
             
         # Log do webhook recebido
-        data = await request.json()
-        logger.info(f"Webhook recebido: {json.dumps(data, indent=2)}")
+        data = orjson.loads(await request.body())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Webhook recebido: {orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()}")
         
         # O webhook vem no formato Evolution API
         if "data" not in data:
@@ -579,7 +812,5 @@ async def webhook_handler(request: Request):
         return {"status": "success", "message": "Mensagem processada"}
         
     except Exception as e:
-        logger.error(f"❌ Erro ao processar webhook: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.exception(f"❌ Erro ao processar webhook: {str(e)}")
         return {"status": "error", "message": f"Erro interno: {str(e)}"}
\ No newline at end of file
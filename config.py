@@ -2,7 +2,9 @@
 import os
 import pathlib
 from dotenv import load_dotenv
-from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from pydantic import BaseModel
 
 # Tentar carregar o .env com caminho explícito
 current_dir = pathlib.Path().absolute()
@@ -10,44 +12,47 @@ env_path = pathlib.Path(current_dir, '.env')
 print(f"Tentando carregar .env de: {env_path}")
 load_dotenv(dotenv_path=env_path)
 
-@dataclass
-class BlingConfig:
+# Modelos pydantic: a validação/coerção de tipos é gerada em Rust
+# (pydantic-core) na criação da classe, em vez do loop manual em Python.
+# Não são frozen porque o main.py atualiza bling.api_key com o token renovado
+class BlingConfig(BaseModel):
     """Configuração para API do Bling"""
     api_key: str
     base_url: str
     # Novas configurações para o OAuth
-    client_id: str = None
-    client_secret: str = None
+    client_id: Optional[str] = None
+    client_secret: Optional[str] = None
 
-@dataclass
-class WhatsAppConfig:
+class WhatsAppConfig(BaseModel):
     """Configuração para Evolution API"""
     api_key: str
     api_url: str
     instance: str  # Usar o nome da instância, não o ID
 
-@dataclass
-class WhatsAppGroup:
+class WhatsAppGroup(BaseModel):
     """Configuração do grupo do WhatsApp"""
     group_id: str
     name: str
 
-@dataclass
-class GroqConfig:
+class GroqConfig(BaseModel):
     """Configuração para API Groq (LLM)"""
     api_key: str
 
-@dataclass
-class Settings:
+class Settings(BaseModel):
     """Configurações globais da aplicação"""
     bling: BlingConfig
     whatsapp: WhatsAppConfig
     group: WhatsAppGroup
     check_interval: int
-    groq: GroqConfig = None  # Opcional, pode não estar configurado
+    groq: Optional[GroqConfig] = None  # Opcional, pode não estar configurado
 
+@lru_cache(maxsize=None)
 def load_settings() -> Settings:
-    """Carrega todas as configurações do arquivo .env"""
+    """
+    Carrega todas as configurações do arquivo .env.
+    Memoizada: o ambiente só é lido na primeira chamada e todos os
+    chamadores compartilham a mesma instância de Settings
+    """
     return Settings(
         bling=BlingConfig(
             api_key=os.getenv('BLING_API_KEY', ''),
@@ -64,7 +69,8 @@ def load_settings() -> Settings:
             group_id=os.getenv('WHATSAPP_GROUP_ID', ''),  
             name=os.getenv('WHATSAPP_GROUP_NAME', '')     
         ),
-        check_interval=int(os.getenv('CHECK_INTERVAL', '30')),
+        # pydantic coage a string do ambiente para int na validação
+        check_interval=os.getenv('CHECK_INTERVAL', '30'),
         groq=GroqConfig(
             api_key=os.getenv('GROQ_API_KEY', '')
         ) if os.getenv('GROQ_API_KEY') else None
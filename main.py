@@ -5,51 +5,85 @@ from config import load_settings, validate_settings  # Importa do config.py
 from bling_stock import BlingStockMonitor, initialize_monitor, app, initialize_stock_agent
 import uvicorn
 import asyncio
-from threading import Thread
+import signal
 import time
 
+# uvloop: event loop em C (libuv) para todo o processo — servidor,
+# renovação de token e envios compartilham o mesmo loop rápido
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    uvloop = None
+
 
 # Novas importações
 from stock_agent import StockAgent  # Novo agente de estoque
 from token_manager import BlingTokenManager  # Gerenciador de token melhorado
 
-# Configuração de logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('stock_monitor.log')
-    ]
-)
+# Configuração de logging com fila: o write() no arquivo e no stream sai
+# do thread do event loop e vai para o thread do QueueListener — o loop só
+# paga um put() na fila por linha de log
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+_log_queue = queue.SimpleQueue()
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_log_sinks = [
+    logging.StreamHandler(),
+    logging.FileHandler('stock_monitor.log')
+]
+for _sink in _log_sinks:
+    _sink.setFormatter(_log_formatter)
+
+# force=True: mesmo que algum import acima tenha tocado o root logger,
+# a configuração com fila vale — sem isso o basicConfig vira no-op e os
+# writes voltam a acontecer no thread do event loop
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)], force=True)
+_log_listener = QueueListener(_log_queue, *_log_sinks, respect_handler_level=True)
+_log_listener.start()
+
 logger = logging.getLogger(__name__)
 
+# Variáveis exibidas no dump de depuração do ambiente (só em nível DEBUG)
+_DEBUG_ENV_KEYS = (
+    'WHATSAPP_GROUP_ID', 'WHATSAPP_GROUP_NAME', 'WHATSAPP_INSTANCE',
+    'WHATSAPP_API_URL', 'BLING_CLIENT_ID', 'GROQ_API_KEY'
+)
+
+# Snapshot imutável das variáveis que não fazem parte do Settings, lido uma
+# única vez no import (o .env já foi carregado pelo import do config acima)
+from types import MappingProxyType
+_ENV = MappingProxyType({
+    'BLING_CALLBACK_URL': os.getenv('BLING_CALLBACK_URL', ''),
+    'BLING_WEBHOOK_RECOVERY_URL': os.getenv('BLING_WEBHOOK_RECOVERY_URL', ''),
+    # Sem defaults embutidos no código: telefone/URLs vêm só do ambiente
+    'ADMIN_PHONE': os.getenv('ADMIN_PHONE', ''),
+})
+
 async def main():
     # Carrega configurações do .env
     settings = load_settings()
     
-    # Depuração dos valores do .env
-    print("\n=== Valores das variáveis de ambiente ===")
-    print(f"WHATSAPP_GROUP_ID: {os.getenv('WHATSAPP_GROUP_ID', 'Não encontrado')}")
-    print(f"WHATSAPP_GROUP_NAME: {os.getenv('WHATSAPP_GROUP_NAME', 'Não encontrado')}")
-    print(f"WHATSAPP_INSTANCE: {os.getenv('WHATSAPP_INSTANCE', 'Não encontrado')}")
-    print(f"WHATSAPP_API_URL: {os.getenv('WHATSAPP_API_URL', 'Não encontrado')}")
-    print(f"WHATSAPP_API_KEY: {os.getenv('WHATSAPP_API_KEY', 'Não encontrado')}")
-    print(f"BLING_CLIENT_ID: {os.getenv('BLING_CLIENT_ID', 'Não encontrado')}")
-    print(f"BLING_CLIENT_SECRET: {os.getenv('BLING_CLIENT_SECRET', 'Não encontrado')[0:5]}...")  # Mostra apenas os primeiros 5 caracteres por segurança
-    print(f"GROQ_API_KEY: {'Configurado' if os.getenv('GROQ_API_KEY') else 'Não encontrado'}")
-    print("=======================================\n")
-    
+    # Depuração dos valores do .env: uma linha lazy, só formata em DEBUG
+    # (os prints antigos despejavam segredos no stdout a cada boot)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("env=%s", {
+            k: os.getenv(k, '<ausente>') for k in _DEBUG_ENV_KEYS
+        })
+
     # Valida configurações
     if not validate_settings(settings):
         logger.error("Configurações inválidas. Verifique o arquivo .env")
         return
     
     try:
+        # Formatação %-deferred: o handler só monta a string se o nível
+        # estiver habilitado (e não paga f-string no caminho do boot)
         logger.info("=== Inicializando Monitor de Estoque via Webhook ===")
-        logger.info(f"Grupo WhatsApp: {settings.group.name}")
-        logger.info(f"ID do Grupo: {settings.group.group_id}")
-        logger.info(f"Instância WhatsApp: {settings.whatsapp.instance}")
+        logger.info("Grupo WhatsApp: %s", settings.group.name)
+        logger.info("ID do Grupo: %s", settings.group.group_id)
+        logger.info("Instância WhatsApp: %s", settings.whatsapp.instance)
         
         # Configuração do WhatsApp para notificações do token manager
         whatsapp_config = {
@@ -60,13 +94,13 @@ async def main():
         
         # Inicializa o token manager aprimorado com detecção de erros e recuperação
         logger.info("Inicializando gerenciador de token melhorado para o monitor...")
-        token_manager = BlingTokenManager(
-            client_id=os.getenv('BLING_CLIENT_ID', ''),
-            client_secret=os.getenv('BLING_CLIENT_SECRET', ''),
-            auth_callback_url=os.getenv('BLING_CALLBACK_URL', ''),
-            webhook_url=os.getenv('BLING_WEBHOOK_RECOVERY_URL', ''),
+        token_manager = BlingTokenManager.instance(
+            client_id=settings.bling.client_id,
+            client_secret=settings.bling.client_secret,
+            auth_callback_url=_ENV['BLING_CALLBACK_URL'],
+            webhook_url=_ENV['BLING_WEBHOOK_RECOVERY_URL'],
             whatsapp_config=whatsapp_config,
-            admin_phone=os.getenv('ADMIN_PHONE', '5516994015075')  # Número para receber alertas
+            admin_phone=_ENV['ADMIN_PHONE']  # Número para receber alertas
         )
         
         valid_token = await token_manager.get_valid_token()
@@ -91,53 +125,80 @@ async def main():
         
         # Define o monitor global para o webhook ANTES de iniciar o servidor
         initialize_monitor(monitor)
-        
-        # Inicia o servidor webhook
+
+        # Inicializa o agente de estoque (se configurado) TAMBÉM antes do
+        # servidor: um webhook que chegasse cedo corria contra os globais
+        # ainda em None
+        agent = await init_stock_agent(settings, token_manager)
+        if agent:
+            logger.info("Inicializando agente de estoque global...")
+            initialize_stock_agent(agent)
+            logger.info("Agente de estoque pronto para processar mensagens")
+
+        # Inicia o job de renovação de token para garantir que o token sempre esteja válido
+        token_manager.start_renewal_job(interval_hours=0.5)
+        logger.info("Job de renovação de token iniciado (verificação a cada 1 hora)")
+
+        # Só agora, com tudo inicializado, abre o servidor para webhooks
         logger.info("Iniciando servidor para receber webhooks...")
         logger.info("Endpoints disponíveis:")
         logger.info("  - /full: Para atualizações do Depósito Full")
         logger.info("  - /principal: Para atualizações do Depósito Normal")
         logger.info("  - /whatsapp: Para processar mensagens do WhatsApp")
         logger.info("  - /: Para verificar o status do servidor")
-        
-        # Usar Thread para executar o uvicorn para evitar conflitos de event loop
-        server_thread = Thread(target=lambda: uvicorn.run(
+
+        # Roda o uvicorn como task no MESMO event loop do main(): um loop só
+        # em vez de dois (o da Thread antiga), sem saltos entre threads para
+        # o monitor compartilhado
+        server_config = uvicorn.Config(
             app,
             host="0.0.0.0",
             port=8000,
-            log_level="info"
-        ))
-        server_thread.daemon = True  # Isso permite que o thread seja encerrado quando o programa principal encerrar
-        server_thread.start()
-        
-        # Aguarda um momento para garantir que o servidor inicializou
+            log_level="info",
+            http="httptools",   # Parser HTTP em C, mais rápido que o h11 puro
+            ws="none",          # Só recebemos webhooks JSON; sem WebSocket
+            access_log=False    # Uma linha de log por request só atrasa o hot path
+        )
+        server = uvicorn.Server(server_config)
+        server_task = asyncio.create_task(server.serve())
+
+        # Espera o startup real do uvicorn em vez de um sleep(2) fixo
         logger.info("Aguardando inicialização do servidor...")
-        await asyncio.sleep(2)
+        while not server.started and not server_task.done():
+            await asyncio.sleep(0.05)
+        if server_task.done():
+            # O servidor morreu no startup (ex.: porta ocupada)
+            await server_task
+            return
         logger.info("Servidor inicializado e pronto para receber webhooks!")
-        
-        # Inicializa o agente de estoque (se configurado)
-        agent = await init_stock_agent(settings, token_manager)
-        if agent:
-            logger.info("Inicializando agente de estoque global...")
-            initialize_stock_agent(agent)
-            logger.info("Agente de estoque pronto para processar mensagens")
-        
-        # Inicia o job de renovação de token para garantir que o token sempre esteja válido
-        token_manager.start_renewal_job(interval_hours=0.5)
-        logger.info("Job de renovação de token iniciado (verificação a cada 1 hora)")
-        
-        # Mantém o programa principal em execução
-        while True:
+
+        # Mantém o programa principal em execução sem acordar o loop a cada
+        # segundo: dorme em um Event e só acorda quando chega SIGINT/SIGTERM
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
             try:
-                await asyncio.sleep(1)
-            except KeyboardInterrupt:
-                logger.info("Servidor encerrado pelo usuário")
-                break
-        
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                # Windows não suporta add_signal_handler; o KeyboardInterrupt
+                # do asyncio.run continua cobrindo o Ctrl+C
+                pass
+
+        await stop.wait()
+        logger.info("Servidor encerrado pelo usuário")
+
+        # Encerra o uvicorn de forma limpa antes de sair
+        server.should_exit = True
+        await server_task
+
+        # Derruba o job de renovação e fecha os clientes HTTP compartilhados
+        token_manager.stop_renewal_job()
+        await token_manager.aclose()
+        await monitor.whatsapp_client.close()
+
     except Exception as e:
-        logger.error(f"Erro durante a execução: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        # logger.exception anexa o traceback sem importar/formatar na mão
+        logger.exception(f"Erro durante a execução: {e}")
 
 async def init_stock_agent(settings, token_manager=None):
     """
@@ -151,10 +212,10 @@ async def init_stock_agent(settings, token_manager=None):
     :return: Instância do StockAgent ou None
     """
     try:
-        # Obter credenciais do ambiente
-        client_id = os.getenv('BLING_CLIENT_ID', '')
-        client_secret = os.getenv('BLING_CLIENT_SECRET', '')
-        groq_api_key = os.getenv('GROQ_API_KEY', '')
+        # Credenciais vêm do Settings memoizado (um único parse do .env)
+        client_id = settings.bling.client_id
+        client_secret = settings.bling.client_secret
+        groq_api_key = settings.groq.api_key if settings.groq else ''
         
         # Verificar se todas as variáveis de ambiente necessárias existem
         if not client_id or not client_secret:
@@ -166,20 +227,22 @@ async def init_stock_agent(settings, token_manager=None):
             return None
         
         # Usar o token manager já inicializado se fornecido, caso contrário criar um novo
+        criou_token_manager = not token_manager
         if not token_manager:
-            # Inicializar o gerenciador de token
+            # Busca o singleton do gerenciador (cria só se ainda não existe):
+            # nunca nasce um segundo manager competindo pelo mesmo token
             logger.info("Inicializando gerenciador de token Bling para o agente...")
-            token_manager = BlingTokenManager(
+            token_manager = BlingTokenManager.instance(
                 client_id=client_id,
                 client_secret=client_secret,
-                auth_callback_url=os.getenv('BLING_CALLBACK_URL', ''),
-                webhook_url=os.getenv('BLING_WEBHOOK_RECOVERY_URL', ''),
+                auth_callback_url=_ENV['BLING_CALLBACK_URL'],
+                webhook_url=_ENV['BLING_WEBHOOK_RECOVERY_URL'],
                 whatsapp_config={
                     'api_key': settings.whatsapp.api_key,
                     'api_url': settings.whatsapp.api_url,
                     'instance': settings.whatsapp.instance
                 },
-                admin_phone=os.getenv('ADMIN_PHONE', '5516994015075')  # Número para receber alertas
+                admin_phone=_ENV['ADMIN_PHONE']  # Número para receber alertas
             )
         
         # Obter token válido (verificação inicial)
@@ -198,10 +261,13 @@ async def init_stock_agent(settings, token_manager=None):
                 logger.error("Todas as tentativas de obter token válido falharam.")
                 return None
             
-        # Inicia job de renovação com intervalo mais frequente (a cada 1 hora)
-        token_manager.start_renewal_job(interval_hours=1)
-        logger.info("Renovação automática de token configurada (a cada 1 hora)")
-            
+        # Só inicia o job de renovação se o manager nasceu aqui; quando o
+        # main() passa o dele, é o main() que inicia o job uma única vez —
+        # dois jobs no mesmo manager competiam pelo rate limit do OAuth
+        if criou_token_manager:
+            token_manager.start_renewal_job(interval_hours=1)
+            logger.info("Renovação automática de token configurada (a cada 1 hora)")
+
         # Inicializar o agente de estoque
         logger.info("Inicializando agente de estoque...")
         agent = StockAgent(
@@ -213,9 +279,7 @@ async def init_stock_agent(settings, token_manager=None):
         return agent
         
     except Exception as e:
-        logger.error(f"Erro ao inicializar agente de estoque: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.exception(f"Erro ao inicializar agente de estoque: {str(e)}")
         return None
     
 @app.get("/ping")
@@ -1,9 +1,10 @@
 import os
 import logging
 from typing import Dict, List, Optional, Any
-from datetime import datetime, timedelta
-import json
+import orjson
 import re
+import time
+from functools import lru_cache
 
 # Importações do Langchain
 from langchain.agents import AgentExecutor, create_structured_chat_agent
@@ -25,11 +26,163 @@ from langchain_community.chat_message_histories import ChatMessageHistory
 # Importações para Bling API v3
 import httpx
 import asyncio
+from cachetools import TTLCache
 
-# Configuração de logging
-logging.basicConfig(level=logging.INFO)
+# Logger do módulo: a configuração do root (handlers, nível) é do main.py
 logger = logging.getLogger("stock_agent")
 
+# Fast path de comandos: mensagens bem formadas ("@estoque adicionar 10
+# unidades do SKU-123 no depósito principal") casam nesta regex
+# precompilada e dispensam a ida ao LLM para extração de parâmetros
+_CMD_RE = re.compile(
+    r"@(?:estoque|bot)\s+"
+    r"(?P<verbo>verificar|consultar|adicionar|remover|transferir)\s+"
+    r"(?:(?P<qtd>\d+(?:[.,]\d+)?)\s+(?:unidades?\s+)?(?:d[oe]\s+)?)?"
+    r"(?P<sku>[A-Za-z0-9][\w\-\./]*)"
+    r"(?:\s+(?:do|no|na|de|em)?\s*(?:depósito\s+)?(?P<dep>principal|padrão|full))?"
+    r"(?:\s+para\s+(?:o\s+)?(?:depósito\s+)?(?P<dep_destino>principal|padrão|full))?",
+    re.IGNORECASE
+)
+
+# Verbo do comando → operation_type usado pelo resto do fluxo
+_CMD_OPERACOES = {
+    "verificar": "consultar",
+    "consultar": "consultar",
+    "adicionar": "adicionar",
+    "remover": "remover",
+    "transferir": "transferir",
+}
+
+# Comandos diretos do process_message, precompilados no import: o scan
+# por mensagem vira uma chamada C do módulo re, sem `in`/any() repetidos
+_CMD_CONFIRM = re.compile(r"@confirmar")
+_CMD_CANCEL = re.compile(r"@cancelar")
+_CMD_HELP = re.compile(r"\b(?:comandos|ajuda|help)\b")
+
+# Verbos que alteram estoque: mensagens com eles nunca saem do cache de
+# respostas do LLM (precisam passar pelo fluxo de confirmação de verdade)
+_RE_VERBO_MUTANTE = re.compile(r"adicionar|remover|transferir|balan[çc]o")
+
+# Formatos de resposta do LLM de extração: bloco ```json, bloco ``` sem
+# linguagem e JSON solto no meio do texto (também precompilados)
+_RE_BLOCO_JSON = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
+_RE_BLOCO_CODIGO = re.compile(r'```\s*(.*?)\s*```', re.DOTALL)
+_RE_JSON_SOLTO = re.compile(r'\{.*\}', re.DOTALL)
+
+# Texto de ajuda dos comandos: literal único de módulo, montado e
+# internado uma vez no import em vez de realocado a cada "ajuda"
+_HELP_TEXT = """📦 *ASSISTENTE DE ESTOQUE - GUIA DE COMANDOS*
+
+Olá! Sou o assistente que gerencia o estoque da Luar Shop. Aqui está tudo que posso fazer:
+
+⚙️ *COMO ME CHAMAR:*
+- Mencione-me diretamente com `@5516993097311` no início da sua mensagem
+
+📊 *OPERAÇÕES DISPONÍVEIS:*
+
+1️⃣ *CONSULTAS DE ESTOQUE*
+  "@mencionar verificar SKU-123"
+  "@mencionar consultar SKU-123"
+  "@mencionar como está o estoque do SKU-123?"
+
+→ _Mostra o nome do produto, quantidade em estoque por depósito e informações de variações/produtos relacionados_
+
+2️⃣ *ADICIONAR ESTOQUE*
+  "@mencionar adicionar 10 unidades do SKU-123"
+  "@mencionar add 5 SKU-456 no depósito principal"
+
+→ _Aumenta o estoque no depósito especificado (ou no Principal se não informado)_
+
+3️⃣ *REMOVER ESTOQUE*
+  "@mencionar remover 3 unidades do SKU-789"
+  "@mencionar baixar 2 SKU-456 do depósito full"
+
+→ _Diminui o estoque do depósito especificado (ou do Principal se não informado)_
+
+4️⃣ *TRANSFERIR ENTRE DEPÓSITOS*
+  "@mencionar transferir 5 SKU-123 do principal para o full"
+  
+→ _Move produtos de um depósito para outro_
+
+5️⃣ *BALANÇO DE ESTOQUE*
+  "@mencionar balanço SKU-123 ajustar para 10 unidades"
+
+→ _Define o estoque para um valor específico (independente do valor atual)_
+
+🏪 *DEPÓSITOS DISPONÍVEIS:*
+- *Depósito Principal* (use "principal" ou "padrão")
+- *Depósito Full* (use "full")
+
+🔐 *PROCESSO DE SEGURANÇA:*
+1. Toda operação que altera estoque exige confirmação
+2. Responda com `@confirmar` para executar ou `@cancelar` para desistir
+3. As operações pendentes expiram após 5 minutos
+
+💡 *DICAS IMPORTANTES:*
+- Use o SKU exato do produto para resultados precisos
+- Para produtos com variações, consulte primeiro o SKU pai
+- Especifique sempre o depósito para evitar erros
+- O sistema funciona apenas em grupos, não em conversas privadas
+- Verifico o estoque antes e depois de cada operação para sua segurança"""
+
+# Prompt de sistema do agente, congelado no import: nada de f-string em
+# runtime — um prefixo estável maximiza reuso de cache no provedor
+_STATIC_SYSTEM = """Você é um assistente especializado em gerenciamento de estoque para e-commerce.
+
+Para consultas de estoque:
+1. Use o comando "@estoque verificar SKU-123" ou "@bot consultar SKU-123"
+2. O sistema mostrará nome, preço e estoque atual do produto
+
+Para adicionar estoque:
+1. Use "@estoque adicionar X unidades do SKU-123"
+2. Especifique o depósito se necessário: "@estoque adicionar X SKU-123 depósito principal"
+
+Para remover estoque:
+1. Use "@estoque remover X unidades do SKU-123"
+2. Especifique o depósito se necessário: "@estoque remover X SKU-123 depósito full"
+
+Para transferir estoque:
+1. Use "@estoque transferir X unidades do SKU-123 do depósito A para B"
+
+Regras importantes:
+1. Sempre confirme operações críticas antes de executar
+2. Mostre o estoque atual antes e depois das operações
+3. Peça confirmação para alterações de estoque
+4. Use números inteiros para quantidades
+5. Sempre responda em português
+
+Você tem acesso às seguintes ferramentas:
+{tools}
+
+Os nomes das ferramentas são: {tool_names}"""
+
+# Descrições das ferramentas expostas ao LLM (constantes de módulo: não
+# há por que remontar essas strings a cada StockAgent criado)
+_SEARCH_TOOL_DESC = (
+    "Busca um produto pelo SKU (código) para verificar se existe e obter "
+    "informações como nome, preço e estoque atual"
+)
+_UPDATE_TOOL_DESC = (
+    "Atualiza o estoque de um produto, podendo adicionar, remover ou "
+    "transferir unidades entre depósitos"
+)
+
+@lru_cache(maxsize=None)
+def _chat_groq_compartilhado(api_key: str, model: str, temperature: float) -> ChatGroq:
+    """
+    Retorna um ChatGroq único por (chave, modelo, temperatura)
+
+    Cada ChatGroq carrega o próprio cliente HTTP; compartilhar a
+    instância entre StockAgents reaproveita o pool de conexões com a
+    Groq em vez de abrir um handshake TLS novo por sessão de usuário
+
+    :param api_key: Chave de API do Groq
+    :param model: Nome do modelo
+    :param temperature: Temperatura de amostragem
+    :return: Instância compartilhada de ChatGroq
+    """
+    return ChatGroq(api_key=api_key, model=model, temperature=temperature)
+
 class BlingStockTool:
     """Classe base para ferramentas de estoque do Bling v3"""
     
@@ -42,20 +195,182 @@ class BlingStockTool:
         """
         self.api_key = api_key
         self.api_url = api_url
+        # Sem Content-Type fixo: o httpx define sozinho quando usamos
+        # json= no POST, e GETs não têm corpo
         self.headers = {
             "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
             "Accept": "application/json"
         }
         self.depositos_map = {
             1511573259: "Depósito Principal",
             13801775465: "Depósito Full"
-        }  # Mapeamento de ID para nome de depósito   
-            
+        }  # Mapeamento de ID para nome de depósito
+        # Mapa inverso (nome/apelido → ID): os depósitos conhecidos
+        # resolvem localmente, sem nenhuma chamada à API
+        self._warehouse_name_to_id = {
+            v.casefold(): k for k, v in self.depositos_map.items()
+        }
+        self._warehouse_name_to_id.update({
+            "principal": 1511573259,
+            "padrão": 1511573259,
+            "full": 13801775465,
+        })
+        # Cliente HTTP compartilhado por todas as chamadas: reaproveita o
+        # pool de conexões e o keep-alive com a API do Bling em vez de
+        # refazer TCP + TLS a cada requisição
+        self.client = httpx.AsyncClient(
+            base_url=api_url,
+            headers=self.headers,
+            # HTTP/2: as consultas concorrentes (gather) multiplexam em
+            # uma única conexão TLS em vez de disputar slots do pool
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=300
+            )
+        )
+        # Cache da lista de depósitos: ela quase nunca muda, então vale
+        # uma consulta a cada 5 minutos em vez de uma por atualização.
+        # O Lock faz misses concorrentes dividirem uma única requisição
+        self._warehouses_cache = None  # (time.monotonic da leitura, lista)
+        self._warehouses_ttl = 300.0
+        self._warehouses_lock = asyncio.Lock()
+        # Cache curto de produtos: o fluxo consultar→atualizar busca o
+        # mesmo SKU duas vezes na mesma conversa, e os metadados (id,
+        # nome) não mudam nesse intervalo. Um lock por chave garante que
+        # buscas concorrentes do mesmo produto façam uma única requisição
+        # TTLCache com teto: entradas vencidas são despejadas pelo
+        # próprio cache em vez de se acumularem a cada SKU distinto
+        self._product_cache = TTLCache(maxsize=4096, ttl=60)
+        self._product_locks = {}   # chave -> asyncio.Lock (single-flight)
+        # Requisições idênticas em voo dividem um único Future: quando o
+        # agente encadeia search_product → update_stock no mesmo SKU, as
+        # consultas concorrentes de saldo/variação viram uma requisição só
+        self._inflight = {}        # chave -> asyncio.Future
+        # Observação das movimentações: o texto só muda quando o minuto
+        # vira, então a string fica cacheada em vez de rodar strftime a
+        # cada atualização de estoque
+        self._obs_cache = (None, "")  # (minuto, observação pronta)
+
+    async def _single_flight(self, key, factory):
+        """
+        Coalesce de requisições idênticas em voo
+
+        :param key: Identificador da requisição (endpoint, parâmetro)
+        :param factory: Corrotina sem argumentos que faz a chamada de fato
+        :return: Resultado compartilhado entre todos os aguardantes
+        """
+        fut = self._inflight.get(key)
+        if fut is not None:
+            # Pega carona na requisição que já está em andamento
+            return await fut
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            resultado = await factory()
+            fut.set_result(resultado)
+            return resultado
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def _enxugar_produto(self, produto: dict) -> dict:
+        """
+        Reduz o produto aos campos que o agente realmente consome
+
+        A API não tem parâmetro de projeção de campos, então o corte é
+        feito aqui logo após o decode: descrições, imagens, tributação
+        etc. são descartados antes de o dicionário entrar no cache,
+        liberando o payload grande para o GC imediatamente
+
+        :param produto: Produto completo vindo da API
+        :return: Dicionário só com id, nome, codigo, idProdutoPai e variações
+        """
+        if not produto:
+            return produto
+        enxuto = {
+            k: produto[k]
+            for k in ("id", "nome", "codigo", "idProdutoPai")
+            if k in produto
+        }
+        variacoes = produto.get("variacoes")
+        if variacoes:
+            enxuto["variacoes"] = [
+                {"id": v.get("id"), "nome": v.get("nome"), "codigo": v.get("codigo")}
+                for v in variacoes
+            ]
+        return enxuto
+
+    def resolve_warehouse_id(self, nome) -> int:
+        """
+        Resolve o nome de um depósito para o ID usando só o mapa estático
+
+        :param nome: Nome ou apelido informado pelo usuário
+        :return: ID do depósito ou None se não for um depósito conhecido
+        """
+        if not nome:
+            return None
+        chave = nome.casefold()
+        dep_id = self._warehouse_name_to_id.get(chave)
+        if dep_id is not None:
+            return dep_id
+        # Apelidos parciais ("no depósito principal", "do full"...)
+        for apelido, dep_id in self._warehouse_name_to_id.items():
+            if apelido in chave:
+                return dep_id
+        return None
+
+    def _produto_cacheado(self, key):
+        """
+        Retorna o produto do cache se ainda estiver dentro do TTL
+
+        :param key: Chave do cache (tipo, valor normalizado)
+        :return: Dados do produto ou None se expirado/ausente
+        """
+        return self._product_cache.get(key)
+
+    async def aclose(self):
+        """Fecha o cliente HTTP compartilhado (usar no shutdown do app)"""
+        if not self.client.is_closed:
+            await self.client.aclose()
+
+
     async def fetch_product_from_api(self, sku: str) -> dict:
+        """
+        Busca um produto pelo SKU, com cache curto e single-flight
+
+        :param sku: SKU do produto a ser buscado
+        :return: Dados do produto ou None se não encontrado
+        """
+        key = ("sku", sku.strip().casefold())
+        cached = self._produto_cacheado(key)
+        if cached is not None:
+            return cached
+
+        lock = self._product_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Quem chegou primeiro pode ter preenchido o cache
+            cached = self._produto_cacheado(key)
+            if cached is not None:
+                return cached
+
+            produto = await self._fetch_product_sem_cache(sku)
+            if produto:
+                # Só cacheia acerto: um "não encontrado" pode ser um
+                # produto recém-criado que aparece na próxima tentativa
+                self._product_cache[key] = produto
+            self._product_locks.pop(key, None)
+            return produto
+
+    async def _fetch_product_sem_cache(self, sku: str) -> dict:
         """
         Busca um produto pelo SKU diretamente da API Bling v3
-        
+
         :param sku: SKU do produto a ser buscado
         :return: Dados do produto ou None se não encontrado
         """
@@ -67,137 +382,195 @@ class BlingStockTool:
                 sku.strip().lower(),             # Tudo minúsculo
             ]
             
-            logger.info(f"Tentando variantes do SKU: {sku_variants}")
-            
+            logger.debug("Tentando variantes do SKU: %s", sku_variants)
+
             # Tenta cada variante até encontrar um resultado
             for variant in sku_variants:
-                url = f"{self.api_url}/produtos"
-                params = {"codigo": variant}
-                
-                async with httpx.AsyncClient() as client:
-                    logger.info(f"Fazendo requisição para: {url} com SKU: {variant}")
-                    response = await client.get(
-                        url, 
-                        headers=self.headers,
-                        params=params,
-                        timeout=10.0
-                    )
-                    
-                    logger.info(f"Status code para variante {variant}: {response.status_code}")
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        
-                        if data.get("data") and len(data["data"]) > 0:
-                            logger.info(f"✅ Produto encontrado com variante {variant}: {data['data'][0].get('nome')}")
-                            return data["data"][0]  # Retorna o primeiro produto encontrado
+                response = await self.client.get("/produtos", params={"codigo": variant})
+
+                logger.debug("Status code para variante %s: %s", variant, response.status_code)
+
+                if response.status_code == 200:
+                    data = orjson.loads(response.content)
+
+                    if data.get("data") and len(data["data"]) > 0:
+                        logger.info(f"✅ Produto encontrado com variante {variant}: {data['data'][0].get('nome')}")
+                        # Retorna o primeiro produto encontrado, já enxuto
+                        return self._enxugar_produto(data["data"][0])
             
             # Se chegou aqui, não encontrou em nenhuma variante
             logger.warning(f"❌ Produto com SKU {sku} não encontrado em nenhuma variante")
             return None
                         
         except Exception as e:
-            logger.error(f"❌ Erro na busca de produto: {str(e)}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
+            # logger.exception anexa o traceback sem importar/formatar na mão
+            logger.exception(f"❌ Erro na busca de produto: {str(e)}")
             return None
 
     async def fetch_product_from_api_by_id(self, product_id: str) -> dict:
+        """
+        Busca um produto pelo ID, com cache curto e single-flight
+
+        :param product_id: ID do produto a ser buscado
+        :return: Dados do produto ou None se não encontrado
+        """
+        key = ("id", str(product_id))
+        cached = self._produto_cacheado(key)
+        if cached is not None:
+            return cached
+
+        lock = self._product_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            cached = self._produto_cacheado(key)
+            if cached is not None:
+                return cached
+
+            produto = await self._fetch_product_by_id_sem_cache(product_id)
+            if produto:
+                self._product_cache[key] = produto
+            self._product_locks.pop(key, None)
+            return produto
+
+    async def _fetch_product_by_id_sem_cache(self, product_id: str) -> dict:
         """
         Busca um produto pelo ID diretamente da API Bling v3
-        
+
         :param product_id: ID do produto a ser buscado
         :return: Dados do produto ou None se não encontrado
         """
         try:
             logger.info(f"Buscando produto com ID: {product_id}")
-            url = f"{self.api_url}/produtos/{product_id}"
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    url, 
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    return data.get("data")
-                else:
-                    logger.error(f"Erro ao buscar produto por ID: {response.status_code} - {response.text}")
-                    return None
+            response = await self.client.get(f"/produtos/{product_id}")
+
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                return self._enxugar_produto(data.get("data"))
+            else:
+                logger.error(f"Erro ao buscar produto por ID: {response.status_code} - {response.text}")
+                return None
         except Exception as e:
             logger.error(f"Erro na busca de produto por ID: {str(e)}")
             return None            
 
     async def fetch_product_variations(self, parent_id: str) -> list:
+        """
+        Busca todas as variações de um produto pai (com coalescing de
+        requisições idênticas em voo)
+
+        :param parent_id: ID do produto pai
+        :return: Lista de variações
+        """
+        return await self._single_flight(
+            ("variacoes", str(parent_id)),
+            lambda: self._fetch_variations_sem_coalesce(parent_id)
+        )
+
+    async def _fetch_variations_sem_coalesce(self, parent_id: str) -> list:
         """
         Busca todas as variações de um produto pai
-        
+
         :param parent_id: ID do produto pai
         :return: Lista de variações
         """
         try:
             logger.info(f"Buscando variações do produto com idProdutoPai: {parent_id}")
-            url = f"{self.api_url}/produtos"
-            params = {"idProdutoPai": parent_id}
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    url, 
-                    headers=self.headers,
-                    params=params,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    variations = data.get("data", [])
-                    logger.info(f"Encontradas {len(variations)} variações para o produto pai ID {parent_id}")
-                    return variations
-                else:
-                    logger.error(f"Erro ao buscar variações: {response.status_code} - {response.text}")
-                    return []
+            response = await self.client.get("/produtos", params={"idProdutoPai": parent_id})
+
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                variations = [self._enxugar_produto(v) for v in data.get("data", [])]
+                logger.info(f"Encontradas {len(variations)} variações para o produto pai ID {parent_id}")
+                return variations
+            else:
+                logger.error(f"Erro ao buscar variações: {response.status_code} - {response.text}")
+                return []
         except Exception as e:
             logger.error(f"Erro ao buscar variações: {str(e)}")
             return []
             
     async def fetch_stock_from_api(self, product_id: str) -> dict:
+        """
+        Obtém o estoque de um produto por ID (consultas idênticas em voo
+        são coalescidas em uma única requisição)
+
+        :param product_id: ID interno do produto no Bling
+        :return: Dados de estoque do produto
+        """
+        return await self._single_flight(
+            ("saldo", str(product_id)),
+            lambda: self._fetch_stock_sem_coalesce(product_id)
+        )
+
+    async def _fetch_stock_sem_coalesce(self, product_id: str) -> dict:
         """
         Obtém o estoque de um produto por ID direto da API Bling
-        
+
         :param product_id: ID interno do produto no Bling
         :return: Dados de estoque do produto
         """
         try:
             # Endpoint correto conforme documentação Bling v3
-            url = f"{self.api_url}/estoques/saldos"
-            params = {"idsProdutos[]": product_id}
-            
-            async with httpx.AsyncClient() as client:
-                logger.info(f"Consultando estoque para produto ID {product_id}")
-                response = await client.get(
-                    url,
-                    headers=self.headers,
-                    params=params,
-                    timeout=10.0
+            logger.debug("Consultando estoque para produto ID %s", product_id)
+            response = await self.client.get(
+                "/estoques/saldos",
+                params={"idsProdutos[]": product_id}
+            )
+
+            logger.debug("Status code estoque: %s", response.status_code)
+
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                # O dump indentado do payload inteiro só é serializado se
+                # o nível DEBUG estiver ativo — em INFO isso era CPU pura
+                # jogada fora a cada consulta
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Dados de estoque recebidos: %s", orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
+                return data
+            else:
+                logger.error(f"Erro ao obter estoque: {response.status_code} - {response.text}")
+                return None
+
+        except Exception as e:
+            logger.error(f"Erro na consulta de estoque: {str(e)}")
+            return None
+
+    async def fetch_stock_bulk(self, product_ids: list) -> dict:
+        """
+        Obtém o saldo de vários produtos em uma única chamada
+
+        O endpoint /estoques/saldos aceita o parâmetro idsProdutos[]
+        repetido, então N consultas individuais viram uma só. IDs são
+        enviados em blocos de 100 para não estourar o tamanho da URL,
+        e os blocos saem em paralelo
+
+        :param product_ids: Lista de IDs internos dos produtos no Bling
+        :return: Dicionário {"data": [...]} com os saldos de todos os IDs
+        """
+        try:
+            chunks = [product_ids[i:i + 100] for i in range(0, len(product_ids), 100)]
+            responses = await asyncio.gather(*(
+                self.client.get(
+                    "/estoques/saldos",
+                    # Lista de tuplas = chave repetida na query string
+                    params=[("idsProdutos[]", pid) for pid in chunk]
                 )
-                
-                logger.info(f"Status code estoque: {response.status_code}")
-                
+                for chunk in chunks
+            ))
+
+            saldos = []
+            for response in responses:
                 if response.status_code == 200:
-                    data = response.json()
-                    logger.info(f"Dados de estoque recebidos: {json.dumps(data, indent=2)}")
-                    return data
+                    saldos.extend(orjson.loads(response.content).get("data", []))
                 else:
-                    logger.error(f"Erro ao obter estoque: {response.status_code} - {response.text}")
-                    return None
-                    
+                    logger.error(f"Erro ao obter estoque em lote: {response.status_code} - {response.text}")
+
+            return {"data": saldos}
+
         except Exception as e:
-            logger.error(f"Erro na consulta de estoque: {str(e)}")
-            return None
-            
-    
+            logger.error(f"Erro na consulta de estoque em lote: {str(e)}")
+            return {"data": []}
+
+
     async def update_stock_in_api(self, product_id: str, warehouse_id: str, operation: str, quantity: float) -> dict:
         """
         Atualiza o estoque de um produto na API do Bling
@@ -209,9 +582,13 @@ class BlingStockTool:
         :return: Resultado da operação
         """
         try:
-            # URL do endpoint de estoques
-            url = f"{self.api_url}/estoques"
-            
+            # Timestamp com granularidade de minuto, regenerado só na virada
+            agora = time.time()
+            minuto = int(agora // 60)
+            if self._obs_cache[0] != minuto:
+                ts = time.strftime("%d/%m/%Y %H:%M", time.localtime(agora))
+                self._obs_cache = (minuto, f"Operação via Assistente de Estoque em {ts}")
+
             # Construir payload sem modificar a operação recebida
             payload = {
                 "produto": {
@@ -222,26 +599,22 @@ class BlingStockTool:
                 },
                 "operacao": operation,  # Usar exatamente o valor recebido (E, S ou B)
                 "quantidade": float(quantity),
-                "observacoes": f"Operação via Assistente de Estoque em {datetime.now().strftime('%d/%m/%Y %H:%M')}"
+                "observacoes": self._obs_cache[1]
             }
             
-            logger.info(f"Enviando payload para atualização de estoque: {json.dumps(payload, indent=2)}")
-                        
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    url,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=10.0
-                )
-                
-                logger.info(f"Status code da atualização: {response.status_code}")
-                
-                if response.status_code in (200, 201, 204):
-                    return {"success": True, "message": "Estoque atualizado com sucesso"}
-                else:
-                    logger.error(f"Erro ao atualizar estoque: {response.status_code} - {response.text}")
-                    return {"success": False, "message": f"Erro: {response.text}"}
+            # Dump do payload só em DEBUG (evita serializar à toa em INFO)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Enviando payload para atualização de estoque: %s", orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
+
+            response = await self.client.post("/estoques", json=payload)
+
+            logger.debug("Status code da atualização: %s", response.status_code)
+
+            if response.status_code in (200, 201, 204):
+                return {"success": True, "message": "Estoque atualizado com sucesso"}
+            else:
+                logger.error(f"Erro ao atualizar estoque: {response.status_code} - {response.text}")
+                return {"success": False, "message": f"Erro: {response.text}"}
                     
         except Exception as e:
             logger.error(f"Erro na atualização de estoque: {str(e)}")
@@ -250,30 +623,36 @@ class BlingStockTool:
     async def fetch_warehouses_from_api(self) -> list:
         """
         Obtém a lista de depósitos disponíveis da API do Bling
-        
+        (com cache de 5 minutos — ver comentário no __init__)
+
         :return: Lista de depósitos
         """
-        try:
-            url = f"{self.api_url}/depositos"
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    url,
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
+        cache = self._warehouses_cache
+        if cache and time.monotonic() - cache[0] < self._warehouses_ttl:
+            return cache[1]
+
+        async with self._warehouses_lock:
+            # Outra corrotina pode ter renovado o cache enquanto esperávamos
+            cache = self._warehouses_cache
+            if cache and time.monotonic() - cache[0] < self._warehouses_ttl:
+                return cache[1]
+
+            try:
+                response = await self.client.get("/depositos")
+
                 if response.status_code == 200:
-                    data = response.json()
+                    data = orjson.loads(response.content)
                     logger.info(f"Dados de depósitos recebidos: {len(data.get('data', []))} depósitos")
-                    return data.get("data", [])
+                    depositos = data.get("data", [])
+                    self._warehouses_cache = (time.monotonic(), depositos)
+                    return depositos
                 else:
                     logger.error(f"Erro ao obter depósitos: {response.status_code} - {response.text}")
                     return []
-                    
-        except Exception as e:
-            logger.error(f"Erro na consulta de depósitos: {str(e)}")
-            return []
+
+            except Exception as e:
+                logger.error(f"Erro na consulta de depósitos: {str(e)}")
+                return []
 
 
 # Classes para definir as entradas e saídas das ferramentas Langchain
@@ -314,14 +693,15 @@ class StockAgent:
         self.bling_tool = BlingStockTool(bling_api_key)
         
         # Inicializa o modelo Groq
-        self.llm = ChatGroq(
-            api_key=groq_api_key,
-            model="llama-3.3-70b-versatile",  # Pode usar outros modelos como "mixtral-8x7b"
-            temperature=0.1
-        )
+        # Instância compartilhada entre agentes com as mesmas credenciais
+        # Pode usar outros modelos como "mixtral-8x7b"
+        self.llm = _chat_groq_compartilhado(groq_api_key, "llama-3.3-70b-versatile", 0.1)
         
         # Configura as ferramentas do agente
         self.tools = self._setup_tools()
+        # Referências diretas às duas ferramentas: os chamadores não
+        # precisam indexar self.tools nem depender da posição na lista
+        self._search_tool, self._update_tool = self.tools
         
         # Inicializa o dicionário de memória para armazenar históricos de conversa
         self.memory_dict = {}
@@ -329,415 +709,459 @@ class StockAgent:
         # Configura o agente
         self.agent_executor = self._setup_agent()
         
-        # Estado da conversa (para gerenciar confirmações)
-        self.conversation_state = {}
+        # Estado da conversa (para gerenciar confirmações). TTLCache
+        # expira a operação pendente sozinho em 5 minutos: sumiu do cache,
+        # expirou — sem timestamps guardados nem varredura de limpeza
+        self.conversation_state = TTLCache(maxsize=100_000, ttl=300)
+
+        # Cache por turno do resultado agregado de search_product: o LLM
+        # costuma chamar a ferramenta mais de uma vez na mesma mensagem
+        # (verificar e logo depois atualizar) — a repetição sai daqui sem
+        # nenhuma chamada à API. Limpo a cada mensagem nova do usuário
+        self._turn_cache = {}      # sku normalizado -> (time.monotonic, json)
+        self._turn_cache_ttl = 30.0
+
+        # Cache de respostas do agente genérico, chaveado por
+        # (user_id, mensagem normalizada): reenvios e duplicatas literais
+        # ("cadê o estoque?") respondem sem pagar a chamada ao LLM de
+        # novo. O user_id na chave importa porque a resposta é gerada
+        # sob o histórico da sessão daquele usuário; e o TTLCache expira
+        # e despeja sozinho em vez de crescer para sempre. Mensagens com
+        # verbos de alteração ficam de fora — essas sempre precisam do
+        # fluxo de confirmação fresco
+        self._llm_cache = TTLCache(maxsize=2048, ttl=3600)
+
+        # Micro-batching das chamadas de extração: mensagens que chegam
+        # na mesma janela de ~25ms (rajada do grupo) saem num abatch
+        # único para a Groq em vez de N requisições isoladas. A fila e o
+        # worker nascem sob demanda porque o __init__ pode rodar antes
+        # de existir event loop
+        self._batch_queue = None
+        self._batch_worker_task = None
+        self._batch_max = 8        # itens por lote
+        self._batch_janela = 0.025 # segundos esperando companhia
         
     def _setup_tools(self):
         """Configura as ferramentas do agente com nomes descritivos"""
-        
-        # Ferramenta para buscar produto
-        async def tool_search_product(sku: str) -> str:
-            """Ferramenta para buscar um produto pelo SKU"""
-            # Definir manualmente os depósitos conhecidos
-            depots_map = self.bling_tool.depositos_map
+        # Nada de closures nem schemas novos por instância: os modelos
+        # pydantic e as descrições vivem no módulo (construídos uma única
+        # vez por processo) e aqui só ligamos os métodos bound da instância
+        search_tool = StructuredTool.from_function(
+            func=self._tool_search_product,
+            name="search_product",  # Nome da ferramenta para o LLM
+            description=_SEARCH_TOOL_DESC,
+            args_schema=ProductSearchInput
+        )
+
+        update_tool = StructuredTool.from_function(
+            func=self._tool_update_stock,
+            name="update_stock",  # Nome da ferramenta para o LLM
+            description=_UPDATE_TOOL_DESC,
+            args_schema=StockUpdateInput
+        )
 
+        return [search_tool, update_tool]
 
-            # Buscar o produto pelo SKU
-            product_data = await self.bling_tool.fetch_product_from_api(sku)
+
+    async def _tool_search_product(self, sku: str) -> str:
+        """Ferramenta para buscar um produto pelo SKU"""
+        # Cache do turno: chamadas repetidas para o mesmo SKU dentro
+        # da mesma mensagem devolvem o JSON já montado
+        chave_turno = sku.strip().casefold()
+        cacheado = self._turn_cache.get(chave_turno)
+        if cacheado and time.monotonic() - cacheado[0] < self._turn_cache_ttl:
+            return cacheado[1]
+
+        # Definir manualmente os depósitos conhecidos
+        depots_map = self.bling_tool.depositos_map
+
+
+        # Buscar o produto pelo SKU
+        product_data = await self.bling_tool.fetch_product_from_api(sku)
             
-            if not product_data:
-                return json.dumps({
-                    "found": False, 
-                    "message": f"Produto com SKU {sku} não encontrado"
-                })
+        if not product_data:
+            return orjson.dumps({
+                "found": False,
+                "message": f"Produto com SKU {sku} não encontrado"
+            }).decode()
             
-            # Verificar se é um produto pai ou filho
-            product_id = product_data.get("id")
-            is_parent = "idProdutoPai" not in product_data or product_data.get("idProdutoPai") is None
-            parent_id = None if is_parent else product_data.get("idProdutoPai")
+        # Verificar se é um produto pai ou filho
+        product_id = product_data.get("id")
+        is_parent = "idProdutoPai" not in product_data or product_data.get("idProdutoPai") is None
+        parent_id = None if is_parent else product_data.get("idProdutoPai")
             
-            # Inicializar o objeto de resposta
-            result = {
-                "found": True,
-                "is_parent": is_parent,
-                "product": {
-                    "id": product_data.get("id"),
-                    "name": product_data.get("nome"),
-                    "sku": product_data.get("codigo")
-                    # Removido preço conforme solicitado
-                },
-                "stock": []
-            }
+        # Inicializar o objeto de resposta
+        result = {
+            "found": True,
+            "is_parent": is_parent,
+            "product": {
+                "id": product_data.get("id"),
+                "name": product_data.get("nome"),
+                "sku": product_data.get("codigo")
+                # Removido preço conforme solicitado
+            },
+            "stock": []
+        }
             
-            # Buscar informações de estoque do produto atual
-            stock_info = await self.bling_tool.fetch_stock_from_api(product_id)
+        # Buscar informações de estoque do produto atual
+        stock_info = await self.bling_tool.fetch_stock_from_api(product_id)
             
-            # Processar estoque do produto atual
-            if stock_info and "data" in stock_info:
-                for stock_item in stock_info.get("data", []):
-                    if str(stock_item.get("produto", {}).get("id")) == str(product_id):
-                        result["product"]["total_stock"] = stock_item.get("saldoVirtualTotal", 0)
-                        
-                        for deposito in stock_item.get("depositos", []):
-                            deposito_id = deposito.get("id")
-                            deposito_nome = depots_map.get(deposito_id, f"Depósito {deposito_id}")
-                            
-                            result["stock"].append({
-                                "warehouse_id": deposito_id,
-                                "warehouse_name": deposito_nome,
-                                "quantity": deposito.get("saldoVirtual", 0)
-                            })
+        # Processar estoque do produto atual: a resposta é indexada por
+        # ID uma vez (um str() por item) em vez do str() duplo a cada
+        # comparação do laço antigo
+        pid_alvo = str(product_id)
+        if stock_info and "data" in stock_info:
+            stock_por_id = {
+                str(item.get("produto", {}).get("id")): item
+                for item in stock_info["data"]
+            }
+            stock_item = stock_por_id.get(pid_alvo)
+            if stock_item:
+                result["product"]["total_stock"] = stock_item.get("saldoVirtualTotal", 0)
+
+                for deposito in stock_item.get("depositos", []):
+                    deposito_id = deposito.get("id")
+                    deposito_nome = depots_map.get(deposito_id, f"Depósito {deposito_id}")
+
+                    result["stock"].append({
+                        "warehouse_id": deposito_id,
+                        "warehouse_name": deposito_nome,
+                        "quantity": deposito.get("saldoVirtual", 0)
+                    })
             
-            # Se é um produto pai, buscar suas variações
-            if is_parent:
-                parent_name = product_data.get("nome", "")
-                logger.info(f"Buscando variações para o produto pai: {parent_name}")
-                
-                # Primeira tentativa: obter o produto pai detalhado que pode conter variações
-                url = f"{self.bling_tool.api_url}/produtos/{product_id}"
+        # Se é um produto pai, buscar suas variações
+        if is_parent:
+            parent_name = product_data.get("nome", "")
+            logger.info(f"Buscando variações para o produto pai: {parent_name}")
                 
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        url,
-                        headers=self.bling_tool.headers,
-                        timeout=10.0
+            # Primeira tentativa: obter o produto pai detalhado que pode
+            # conter variações. O corpo é lido em streaming (aread) e as
+            # variações são enxugadas na hora: para pais com centenas de
+            # variações, o payload completo não fica vivo além do decode
+            async with self.bling_tool.client.stream(
+                "GET", f"/produtos/{product_id}"
+            ) as response:
+                status_pai = response.status_code
+                corpo_pai = await response.aread() if status_pai == 200 else b""
+
+            variations_data = []
+
+            if status_pai == 200:
+                parent_full = orjson.loads(corpo_pai).get("data", {})
+                corpo_pai = None  # libera os bytes do payload
+
+                # Verificar se o produto pai já tem variações listadas
+                if "variacoes" in parent_full and parent_full["variacoes"]:
+                    logger.info(f"Encontradas {len(parent_full['variacoes'])} variações no produto pai")
+                    # Só os três campos usados de cada variação
+                    variations_data = [
+                        {"id": v.get("id"), "nome": v.get("nome"), "codigo": v.get("codigo")}
+                        for v in parent_full["variacoes"]
+                    ]
+                    parent_full = None  # resto do produto pai não é usado
+                else:
+                    # Segunda tentativa: buscar variações e filtrar manualmente
+                    params = {
+                        "idProdutoPai": product_id,
+                        "tipo": "V",  # Apenas variações
+                        "limite": 100
+                    }
+
+                    variations_response = await self.bling_tool.client.get(
+                        "/produtos",
+                        params=params
                     )
-                    
-                    variations_data = []
-                    
-                    if response.status_code == 200:
-                        parent_full = response.json().get("data", {})
-                        
-                        # Verificar se o produto pai já tem variações listadas
-                        if "variacoes" in parent_full and parent_full["variacoes"]:
-                            logger.info(f"Encontradas {len(parent_full['variacoes'])} variações no produto pai")
-                            variations_data = parent_full["variacoes"]
-                        else:
-                            # Segunda tentativa: buscar variações e filtrar manualmente
-                            variations_url = f"{self.bling_tool.api_url}/produtos"
-                            params = {
-                                "idProdutoPai": product_id,
-                                "tipo": "V",  # Apenas variações
-                                "limite": 100
-                            }
-                            
-                            variations_response = await client.get(
-                                variations_url,
-                                headers=self.bling_tool.headers,
-                                params=params,
-                                timeout=10.0
-                            )
-                            
-                            if variations_response.status_code == 200:
-                                all_variations = variations_response.json().get("data", [])
-                                logger.info(f"Obtidas {len(all_variations)} variações da API")
-                                
-                                # Filtro manual: variação deve ter o nome do produto pai como prefixo
-                                for var in all_variations:
-                                    var_name = var.get("nome", "")
-                                    # Verifica se é uma variação real comparando nomes
-                                    if var_name.startswith(parent_name):
-                                        variations_data.append(var)
-                                
-                                logger.info(f"Após filtro manual, {len(variations_data)} variações são realmente relacionadas")
-                    
-                    # Processar apenas as variações relacionadas
-                    result["variations"] = []
-                    
-                    for variation in variations_data:
-                        variation_id = variation.get("id")
-                        variation_info = {
-                            "id": variation_id,
-                            "name": variation.get("nome"),
-                            "sku": variation.get("codigo"),
-                            "stock": []
-                        }
-                        
-                        # Buscar estoque da variação
-                        variation_stock = await self.bling_tool.fetch_stock_from_api(variation_id)
-                        
-                        if variation_stock and "data" in variation_stock:
-                            for stock_item in variation_stock.get("data", []):
-                                if str(stock_item.get("produto", {}).get("id")) == str(variation_id):
-                                    for deposito in stock_item.get("depositos", []):
-                                        deposito_id = deposito.get("id")
-                                        deposito_nome = depots_map.get(deposito_id, f"Depósito {deposito_id}")
-                                        
-                                        variation_info["stock"].append({
-                                            "warehouse_id": deposito_id,
-                                            "warehouse_name": deposito_nome,
-                                            "quantity": deposito.get("saldoVirtual", 0)
-                                        })
-                        
-                        result["variations"].append(variation_info)
+
+                    if variations_response.status_code == 200:
+                        all_variations = orjson.loads(variations_response.content).get("data", [])
+                        logger.info(f"Obtidas {len(all_variations)} variações da API")
+
+                        # Filtro manual: variação deve ter o nome do produto pai como prefixo
+                        for var in all_variations:
+                            var_name = var.get("nome", "")
+                            # Verifica se é uma variação real comparando nomes
+                            if var_name.startswith(parent_name):
+                                variations_data.append({
+                                    "id": var.get("id"),
+                                    "nome": var_name,
+                                    "codigo": var.get("codigo")
+                                })
+
+                        logger.info(f"Após filtro manual, {len(variations_data)} variações são realmente relacionadas")
+
+            # Processar apenas as variações relacionadas
+            result["variations"] = []
+
+            # Uma única chamada em lote no lugar de uma consulta de
+            # saldo por variação (idsProdutos[] repetido na query),
+            # com o resultado indexado por ID de produto
+            variation_ids = [v.get("id") for v in variations_data]
+            bulk_stock = await self.bling_tool.fetch_stock_bulk(variation_ids)
+            stock_por_produto = {
+                str(item.get("produto", {}).get("id")): item
+                for item in bulk_stock.get("data", [])
+            }
+
+            for variation in variations_data:
+                variation_id = variation.get("id")
+                variation_info = {
+                    "id": variation_id,
+                    "name": variation.get("nome"),
+                    "sku": variation.get("codigo"),
+                    "stock": []
+                }
+
+                stock_item = stock_por_produto.get(str(variation_id))
+                if stock_item:
+                    for deposito in stock_item.get("depositos", []):
+                        deposito_id = deposito.get("id")
+                        deposito_nome = depots_map.get(deposito_id, f"Depósito {deposito_id}")
+
+                        variation_info["stock"].append({
+                            "warehouse_id": deposito_id,
+                            "warehouse_name": deposito_nome,
+                            "quantity": deposito.get("saldoVirtual", 0)
+                        })
+
+                result["variations"].append(variation_info)
             
-            # Se é um produto filho, buscar apenas informações do pai            
-            elif parent_id:
-                url = f"{self.bling_tool.api_url}/produtos/{parent_id}"
-                
-                logger.info(f"Buscando produto pai completo com ID: {parent_id}")
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        url,
-                        headers=self.bling_tool.headers,
-                        timeout=10.0
-                    )
-                    
-                    if response.status_code == 200:
-                        parent_data = response.json().get("data")
-                        
-                        if parent_data:
-                            # Informações do pai
-                            result["parent"] = {
-                                "id": parent_data.get("id"),
-                                "name": parent_data.get("nome"),
-                                "sku": parent_data.get("codigo")
-                            }
-                            
-                            # Variações já vêm na resposta!
-                            if "variacoes" in parent_data and parent_data["variacoes"]:
-                                result["siblings"] = []
-                                
-                                for sibling in parent_data["variacoes"]:
-                                    # Não incluir a própria variação
-                                    if str(sibling.get("id")) != str(product_id):
-                                        result["siblings"].append({
-                                            "id": sibling.get("id"),
-                                            "name": sibling.get("nome"),
-                                            "sku": sibling.get("codigo")
-                                        })
+        # Se é um produto filho, buscar apenas informações do pai            
+        elif parent_id:
+            logger.info(f"Buscando produto pai completo com ID: {parent_id}")
+
+            response = await self.bling_tool.client.get(f"/produtos/{parent_id}")
+
+            if response.status_code == 200:
+                parent_data = orjson.loads(response.content).get("data")
+
+                if parent_data:
+                    # Informações do pai
+                    result["parent"] = {
+                        "id": parent_data.get("id"),
+                        "name": parent_data.get("nome"),
+                        "sku": parent_data.get("codigo")
+                    }
+
+                    # Variações já vêm na resposta!
+                    if "variacoes" in parent_data and parent_data["variacoes"]:
+                        result["siblings"] = []
+
+                        for sibling in parent_data["variacoes"]:
+                            # Não incluir a própria variação
+                            if str(sibling.get("id")) != pid_alvo:
+                                result["siblings"].append({
+                                    "id": sibling.get("id"),
+                                    "name": sibling.get("nome"),
+                                    "sku": sibling.get("codigo")
+                                })
             
-            return json.dumps(result)
+        resposta = orjson.dumps(result).decode()
+        self._turn_cache[chave_turno] = (time.monotonic(), resposta)
+        return resposta
 
-        # Cria a ferramenta estruturada com um nome descritivo
-        search_tool = StructuredTool.from_function(
-            func=tool_search_product,  # Usa a função com nome descritivo
-            name="search_product",  # Nome da ferramenta para o LLM
-            description="Busca um produto pelo SKU (código) para verificar se existe e obter informações como nome, preço e estoque atual",
-            args_schema=ProductSearchInput
-        )
-        
-        # Ferramenta para atualizar estoque
-        async def tool_update_stock(
-            sku: str,
-            quantity: float,
-            operation: str,
-            warehouse: str = None,
-            target_warehouse: str = None
-        ) -> str:
-            """
-            Ferramenta para atualizar o estoque de um produto
+    async def _tool_update_stock(
+        self,
+        sku: str,
+        quantity: float,
+        operation: str,
+        warehouse: str = None,
+        target_warehouse: str = None
+    ) -> str:
+        """
+        Ferramenta para atualizar o estoque de um produto
             
-            Args:
-                sku: Código SKU do produto
-                quantity: Quantidade a ser adicionada ou removida
-                operation: Operação (adicionar, remover, transferir)
-                warehouse: Depósito de origem
-                target_warehouse: Depósito de destino (para transferências)
+        Args:
+            sku: Código SKU do produto
+            quantity: Quantidade a ser adicionada ou removida
+            operation: Operação (adicionar, remover, transferir)
+            warehouse: Depósito de origem
+            target_warehouse: Depósito de destino (para transferências)
                 
-            Returns:
-                String com resultado da operação
-            """
-            # Implementação da atualização de estoque...
-            try:
-                # Primeiro, busca o produto
-                product_data = await self.bling_tool.fetch_product_from_api(sku)
+        Returns:
+            String com resultado da operação
+        """
+        # Implementação da atualização de estoque...
+        try:
+            # Primeiro, busca o produto
+            product_data = await self.bling_tool.fetch_product_from_api(sku)
                 
-                if not product_data:
-                    return json.dumps({
-                        "success": False,
-                        "message": f"Produto com SKU {sku} não encontrado"
-                    })
+            if not product_data:
+                return orjson.dumps({
+                    "success": False,
+                    "message": f"Produto com SKU {sku} não encontrado"
+                }).decode()
                 
-                # Obter ID do produto
-                product_id = product_data.get("id")
-                product_name = product_data.get("nome")
+            # Obter ID do produto
+            product_id = product_data.get("id")
+            product_name = product_data.get("nome")
                 
-                # Buscar depósitos
+            # Caminho rápido: os depósitos conhecidos resolvem pelo mapa
+            # estático da ferramenta, sem nenhuma chamada à API
+            warehouse_id = self.bling_tool.resolve_warehouse_id(warehouse)
+            target_warehouse_id = None
+            if operation == "transferir" and target_warehouse:
+                target_warehouse_id = self.bling_tool.resolve_warehouse_id(target_warehouse)
+
+            falta_origem = warehouse and not warehouse_id
+            falta_destino = operation == "transferir" and target_warehouse and not target_warehouse_id
+
+            if falta_origem or falta_destino:
+                # Só agora busca a lista de depósitos (cacheada) e monta
+                # o índice nome→id para os nomes que não resolveram
                 warehouses = await self.bling_tool.fetch_warehouses_from_api()
-                
-                # Usar o mapeamento existente para preencher os nomes dos depósitos
-                warehouses_with_names = []
+
+                name_to_id = {}
                 for w in warehouses:
                     depot_id = w.get("id")
                     # Usar o mapeamento conhecido ao invés dos nomes vazios da API
                     nome = self.bling_tool.depositos_map.get(depot_id, "Depósito Desconhecido")
-                    warehouses_with_names.append({"id": depot_id, "nome": nome.lower()})
+                    name_to_id[nome.casefold()] = depot_id
 
-                logger.info(f"Depósitos disponíveis: {warehouses_with_names}")
+                logger.info(f"Depósitos disponíveis: {name_to_id}")
 
-                # Código para encontrar o depósito de origem:
-                warehouse_id = None
-                if warehouse:
-                    warehouse_lower = warehouse.lower()
-                    for w in warehouses_with_names:
-                        nome_deposito = w.get("nome", "").lower()
-                        
-                        if "principal" in nome_deposito and ("principal" in warehouse_lower or "padrão" in warehouse_lower):
-                            warehouse_id = w.get("id")
-                            logger.info(f"Depósito PRINCIPAL encontrado: {nome_deposito} (ID: {warehouse_id})")
-                            break
-                        elif "full" in nome_deposito and "full" in warehouse_lower:
-                            warehouse_id = w.get("id")
-                            logger.info(f"Depósito FULL encontrado: {nome_deposito} (ID: {warehouse_id})")
-                            break
-
-                # Encontrar ID do depósito de destino para transferências - VERSÃO MELHORADA
-                target_warehouse_id = None
-                if operation == "transferir" and target_warehouse:
-                    target_warehouse_lower = target_warehouse.lower()
-                    for w in warehouses_with_names:
-                        nome_deposito = w.get("nome", "").lower()
-                        
-                        if "principal" in nome_deposito and ("principal" in target_warehouse_lower or "padrão" in target_warehouse_lower):
-                            target_warehouse_id = w.get("id")
-                            logger.info(f"Depósito de destino (PRINCIPAL) encontrado: {nome_deposito} (ID: {target_warehouse_id})")
-                            break
-                        elif "full" in nome_deposito and "full" in target_warehouse_lower:
-                            target_warehouse_id = w.get("id")
-                            logger.info(f"Depósito de destino (FULL) encontrado: {nome_deposito} (ID: {target_warehouse_id})")
-                            break
+                def resolver_deposito(entrada):
+                    """Resolve o nome informado pelo usuário para o ID do depósito"""
+                    if not entrada:
+                        return None
+                    chave = entrada.casefold()
+                    dep_id = name_to_id.get(chave)
+                    if dep_id is not None:
+                        return dep_id
+                    # Fallback em uma única passada para apelidos parciais
+                    # ("principal", "padrão", "full")
+                    if "principal" in chave or "padrão" in chave:
+                        chave = "principal"
+                    elif "full" in chave:
+                        chave = "full"
+                    for nome, dep_id in name_to_id.items():
+                        if chave in nome:
+                            return dep_id
+                    return None
+
+                if falta_origem:
+                    warehouse_id = resolver_deposito(warehouse)
+                if falta_destino:
+                    target_warehouse_id = resolver_deposito(target_warehouse)
+
+            if warehouse_id:
+                logger.info(f"Depósito de origem: {warehouse} (ID: {warehouse_id})")
+            if target_warehouse_id:
+                logger.info(f"Depósito de destino: {target_warehouse} (ID: {target_warehouse_id})")
                 
-                # Verificar se encontrou os depósitos
-                if not warehouse_id:
-                    return json.dumps({
-                        "success": False,
-                        "message": "Depósito de origem não encontrado"
-                    })
+            # Verificar se encontrou os depósitos
+            if not warehouse_id:
+                return orjson.dumps({
+                    "success": False,
+                    "message": "Depósito de origem não encontrado"
+                }).decode()
                 
-                if operation == "transferir" and not target_warehouse_id:
-                    return json.dumps({
-                        "success": False,
-                        "message": "Depósito de destino não encontrado"
-                    })
+            if operation == "transferir" and not target_warehouse_id:
+                return orjson.dumps({
+                    "success": False,
+                    "message": "Depósito de destino não encontrado"
+                }).decode()
                 
-                # Executar a operação
-                result = None
+            # Executar a operação
+            result = None
                 
-                if operation == "adicionar":
-                    # Adicionar estoque (Entrada)
-                    result = await self.bling_tool.update_stock_in_api(
-                        product_id=product_id,
-                        warehouse_id=warehouse_id,
-                        operation="E",  # E = Entrada
-                        quantity=abs(quantity)  # Garante que seja positivo
-                    )
+            if operation == "adicionar":
+                # Adicionar estoque (Entrada)
+                result = await self.bling_tool.update_stock_in_api(
+                    product_id=product_id,
+                    warehouse_id=warehouse_id,
+                    operation="E",  # E = Entrada
+                    quantity=abs(quantity)  # Garante que seja positivo
+                )
                     
-                elif operation == "remover":
-                    # Remover estoque (Saída)
-                    result = await self.bling_tool.update_stock_in_api(
-                        product_id=product_id,
-                        warehouse_id=warehouse_id,
-                        operation="S",  # S = Saída
-                        quantity=abs(quantity)  # Garante que seja positivo
-                    )
+            elif operation == "remover":
+                # Remover estoque (Saída)
+                result = await self.bling_tool.update_stock_in_api(
+                    product_id=product_id,
+                    warehouse_id=warehouse_id,
+                    operation="S",  # S = Saída
+                    quantity=abs(quantity)  # Garante que seja positivo
+                )
                     
-                elif operation == "transferir":
-                    # Transferir = Saída de um depósito + Entrada em outro
-                    # 1. Saída do primeiro depósito
-                    result_saida = await self.bling_tool.update_stock_in_api(
+            elif operation == "transferir":
+                # Transferir = Saída de um depósito + Entrada em outro.
+                # As duas operações tocam depósitos diferentes, então
+                # saem em paralelo com gather (2 round trips viram 1)
+                result_saida, result_entrada = await asyncio.gather(
+                    self.bling_tool.update_stock_in_api(
                         product_id=product_id,
                         warehouse_id=warehouse_id,
                         operation="S",
                         quantity=abs(quantity)
-                    )
-                    
-                    # 2. Entrada no segundo depósito
-                    result_entrada = await self.bling_tool.update_stock_in_api(
+                    ),
+                    self.bling_tool.update_stock_in_api(
                         product_id=product_id,
                         warehouse_id=target_warehouse_id,
                         operation="E",
                         quantity=abs(quantity)
-                    )
+                    ),
+                    return_exceptions=True
+                )
+
+                # Exceção em uma das pernas vira o dict de erro padrão
+                # em vez de cancelar a outra perna já disparada
+                if isinstance(result_saida, BaseException):
+                    result_saida = {"success": False, "message": f"Erro: {result_saida}"}
+                if isinstance(result_entrada, BaseException):
+                    result_entrada = {"success": False, "message": f"Erro: {result_entrada}"}
                     
-                    # Combina os resultados
-                    if result_saida.get("success", False) and result_entrada.get("success", False):
-                        result = {
-                            "success": True,
-                            "message": f"Transferência de {quantity} unidades do produto realizada com sucesso"
-                        }
-                    else:
-                        result = {
-                            "success": False,
-                            "message": "Erro na transferência: " + 
-                                      result_saida.get("message", "") + " / " + 
-                                      result_entrada.get("message", "")
-                        }          
+                # Combina os resultados
+                if result_saida.get("success", False) and result_entrada.get("success", False):
+                    result = {
+                        "success": True,
+                        "message": f"Transferência de {quantity} unidades do produto realizada com sucesso"
+                    }
+                else:
+                    result = {
+                        "success": False,
+                        "message": "Erro na transferência: " + 
+                                  result_saida.get("message", "") + " / " + 
+                                  result_entrada.get("message", "")
+                    }          
                 
-                elif operation == "balanço":
-                    result = await self.bling_tool.update_stock_in_api(
-                        product_id=product_id,
-                        warehouse_id=warehouse_id,
-                        operation="B",  # B = Balanço
-                        quantity=quantity  # Quantidade total desejada
-                    )
+            elif operation == "balanço":
+                result = await self.bling_tool.update_stock_in_api(
+                    product_id=product_id,
+                    warehouse_id=warehouse_id,
+                    operation="B",  # B = Balanço
+                    quantity=quantity  # Quantidade total desejada
+                )
                 
-                # Formata a resposta
-                return json.dumps({
-                    "success": result.get("success", False),
-                    "message": result.get("message", "Operação concluída"),
-                    "product": {
-                        "id": product_id,
-                        "name": product_name,
-                        "sku": sku
-                    },
-                    "operation": operation,
-                    "quantity": quantity
-                })
+            # Formata a resposta
+            return orjson.dumps({
+                "success": result.get("success", False),
+                "message": result.get("message", "Operação concluída"),
+                "product": {
+                    "id": product_id,
+                    "name": product_name,
+                    "sku": sku
+                },
+                "operation": operation,
+                "quantity": quantity
+            }).decode()
                 
-            except Exception as e:
-                logger.error(f"Erro ao atualizar estoque: {str(e)}")
-                import traceback
-                logger.error(traceback.format_exc())
-                return json.dumps({
-                    "success": False,
-                    "message": f"Erro ao processar operação: {str(e)}"
-                })
-        
-        # Cria a ferramenta estruturada
-        update_tool = StructuredTool.from_function(
-            func=tool_update_stock,  # Usa a função com nome descritivo
-            name="update_stock",  # Nome da ferramenta para o LLM
-            description="Atualiza o estoque de um produto, podendo adicionar, remover ou transferir unidades entre depósitos",
-            args_schema=StockUpdateInput
-        )
-        
-        return [search_tool, update_tool]
+        except Exception as e:
+            logger.exception(f"Erro ao atualizar estoque: {str(e)}")
+            return orjson.dumps({
+                "success": False,
+                "message": f"Erro ao processar operação: {str(e)}"
+            }).decode()
+
         
     def _setup_agent(self):
         """Configura o agente com as ferramentas e prompt"""
         
-        # Define o template do prompt com todas as variáveis necessárias
+        # Define o template do prompt com todas as variáveis necessárias.
+        # O texto do sistema é o _STATIC_SYSTEM congelado no módulo e fica
+        # como primeiro bloco contíguo do contexto, antes do histórico e do
+        # input: prefixo idêntico turno a turno é o que o cache de prompt
+        # do provedor consegue reaproveitar
         prompt = ChatPromptTemplate.from_messages([
-            ("system", """Você é um assistente especializado em gerenciamento de estoque para e-commerce.
-
-Para consultas de estoque:
-1. Use o comando "@estoque verificar SKU-123" ou "@bot consultar SKU-123"
-2. O sistema mostrará nome, preço e estoque atual do produto
-
-Para adicionar estoque:
-1. Use "@estoque adicionar X unidades do SKU-123"
-2. Especifique o depósito se necessário: "@estoque adicionar X SKU-123 depósito principal"
-
-Para remover estoque:
-1. Use "@estoque remover X unidades do SKU-123"
-2. Especifique o depósito se necessário: "@estoque remover X SKU-123 depósito full"
-
-Para transferir estoque:
-1. Use "@estoque transferir X unidades do SKU-123 do depósito A para B"
-
-Regras importantes:
-1. Sempre confirme operações críticas antes de executar
-2. Mostre o estoque atual antes e depois das operações
-3. Peça confirmação para alterações de estoque
-4. Use números inteiros para quantidades
-5. Sempre responda em português
-
-Você tem acesso às seguintes ferramentas:
-{tools}
-
-Os nomes das ferramentas são: {tool_names}"""),
+            ("system", _STATIC_SYSTEM),
             MessagesPlaceholder(variable_name="chat_history"),
             ("human", "{input}"),
             MessagesPlaceholder(variable_name="agent_scratchpad"),
@@ -792,14 +1216,417 @@ Os nomes das ferramentas são: {tool_names}"""),
 
         return agent_executor
 
+    def _comando_local(self, message: str):
+        """
+        Tenta resolver a mensagem como comando estruturado, sem LLM
+
+        :param message: Mensagem recebida do usuário
+        :return: Dicionário no mesmo formato da extração via LLM, ou
+                 None se a mensagem não casar com a regex de comandos
+        """
+        match = _CMD_RE.search(message)
+        if not match:
+            return None
+
+        # Só vale como casamento confiante se a mensagem terminou ali:
+        # sobrou texto depois do SKU/depósito ("... do depósito X") é
+        # coisa que a regex não entendeu — deixa para o LLM extrair em
+        # vez de responder com confidence 1.0 e o pedaço ignorado
+        resto = message[match.end():].strip()
+        if resto and not all(c in "?!." for c in resto):
+            logger.info(f"Comando com texto não reconhecido após o match ({resto!r}), indo para o LLM")
+            return None
+
+        qtd = match.group("qtd")
+        params = {
+            "operation_type": _CMD_OPERACOES[match.group("verbo").casefold()],
+            "sku": match.group("sku"),
+            "quantity": float(qtd.replace(",", ".")) if qtd else None,
+            "source_warehouse": match.group("dep"),
+            "target_warehouse": match.group("dep_destino"),
+            "confidence": 1.0
+        }
+        logger.info(f"Comando resolvido localmente, sem LLM: {params}")
+        return params
+
+    async def _extrair_params_llm(self, message: str) -> dict:
+        """
+        Extrai a intenção e os parâmetros da mensagem usando o LLM
+
+        :param message: Mensagem recebida do usuário
+        :return: Dicionário de parâmetros extraídos
+        """
+        extraction_prompt = f"""
+        Analise esta mensagem e extraia as informações relevantes para gerenciamento de estoque:
+        "{message}"
+
+        Responda apenas em formato JSON com as seguintes chaves:
+        {{
+            "operation_type": "consultar"|"adicionar"|"remover"|"transferir"|"balanço"|"outro",
+            "sku": "código do produto ou null se não houver",
+            "quantity": número ou null se não aplicável,
+            "source_warehouse": "depósito onde a operação será realizada (ou origem no caso de transferência)",
+            "target_warehouse": "depósito destino (apenas para transferências)",
+            "confidence": número entre 0 e 1 indicando sua confiança nesta interpretação
+        }}
+
+        Para operações "adicionar", "remover" ou "balanço", o depósito mencionado deve ser extraído como "source_warehouse".
+        Para "transferir", extraia o depósito de origem como "source_warehouse" e o destino como "target_warehouse".
+        """
+
+        logger.info(f"Extraindo parâmetros via LLM para a mensagem: '{message}'")
+
+        # Usar o LLM para extrair parâmetros estruturados (via fila de
+        # micro-batching: rajadas simultâneas viram um abatch só)
+        extraction_response = await self._llm_em_lote([
+            {"role": "system", "content": "Você é um analisador de texto que extrai parâmetros estruturados."},
+            {"role": "user", "content": extraction_prompt}
+        ])
+
+        extracted_text = extraction_response.content
+        logger.info(f"Texto extraído do LLM: {extracted_text[:100]}...")
+
+        # Verificar se a resposta está vazia
+        if not extracted_text or extracted_text.isspace():
+            logger.warning("Resposta de extração vazia, usando fallback")
+            raise ValueError("Resposta vazia")
+
+        # Limpar o texto para garantir que temos apenas JSON válido
+        json_text = None
+
+        # Tentar diferentes formatos comuns
+        if "```json" in extracted_text:
+            # Formato código markdown
+            match = _RE_BLOCO_JSON.search(extracted_text)
+            if match:
+                json_text = match.group(1)
+        elif "```" in extracted_text:
+            # Outro formato de código sem especificar json
+            match = _RE_BLOCO_CODIGO.search(extracted_text)
+            if match:
+                json_text = match.group(1)
+        elif "{" in extracted_text and "}" in extracted_text:
+            # JSON sem formatação de código
+            match = _RE_JSON_SOLTO.search(extracted_text)
+            if match:
+                json_text = match.group(0)
+
+        # Se não conseguiu extrair, usar o texto completo
+        if not json_text:
+            json_text = extracted_text.strip()
+
+        logger.info(f"Tentando processar JSON: {json_text[:100]}...")
+
+        # Tentar fazer parse do JSON
+        try:
+            params = orjson.loads(json_text)
+            logger.info(f"Parâmetros extraídos pela IA: {params}")
+        except orjson.JSONDecodeError:
+            # Se falhar, criar um objeto JSON padrão para indicar baixa confiança
+            logger.warning("Falha ao decodificar JSON, usando objeto padrão")
+            params = {
+                "operation_type": "outro",
+                "sku": None,
+                "quantity": None,
+                "source_warehouse": None,
+                "target_warehouse": None,
+                "confidence": 0.1
+            }
+        return params
+
+    async def _llm_em_lote(self, mensagens: list):
+        """
+        Enfileira uma chamada de chat e espera o resultado do lote
+
+        :param mensagens: Lista de mensagens no formato role/content
+        :return: Resposta do LLM para esta entrada
+        """
+        if self._batch_queue is None:
+            self._batch_queue = asyncio.Queue()
+            self._batch_worker_task = asyncio.create_task(self._batch_worker())
+
+        fut = asyncio.get_running_loop().create_future()
+        await self._batch_queue.put((mensagens, fut))
+        return await fut
+
+    async def _batch_worker(self):
+        """
+        Drena a fila de chamadas em janelas curtas e despacha um abatch
+
+        Pega o primeiro item que chegar, espera até _batch_janela por
+        companhia (máx. _batch_max itens), deduplica entradas idênticas
+        e resolve o future de cada chamador com a resposta do lote
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            lote = [await self._batch_queue.get()]
+            prazo = loop.time() + self._batch_janela
+            while len(lote) < self._batch_max:
+                restante = prazo - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(await asyncio.wait_for(self._batch_queue.get(), restante))
+                except asyncio.TimeoutError:
+                    break
+
+            # Dedup dentro do lote: dois chamadores com a mesma entrada
+            # compartilham uma única posição no abatch
+            indices = {}
+            entradas = []
+            posicoes = []
+            for mensagens, _ in lote:
+                chave = repr(mensagens)
+                if chave not in indices:
+                    indices[chave] = len(entradas)
+                    entradas.append(mensagens)
+                posicoes.append(indices[chave])
+
+            try:
+                if len(entradas) == 1:
+                    respostas = [await self.llm.ainvoke(entradas[0])]
+                else:
+                    logger.info(f"Lote de extração com {len(lote)} chamadas ({len(entradas)} únicas)")
+                    respostas = await self.llm.abatch(entradas)
+            except Exception as e:
+                for _, fut in lote:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+
+            for (_, fut), pos in zip(lote, posicoes):
+                if not fut.done():
+                    fut.set_result(respostas[pos])
+
+    async def _agente_generico(self, user_id: str, message: str) -> str:
+        """
+        Invoca o agente LLM genérico, com cache de mensagens repetidas
+
+        :param user_id: Identificador da sessão do usuário
+        :param message: Mensagem recebida do usuário
+        :return: Resposta em texto do agente
+        """
+        chave = None
+        msg_lower = message.lower()
+        if not _RE_VERBO_MUTANTE.search(msg_lower):
+            # Normaliza espaçamento/caixa para capturar reenvios literais;
+            # o user_id entra na chave porque a resposta depende do
+            # histórico da sessão de quem perguntou
+            chave = (user_id, " ".join(msg_lower.split()))
+            em_cache = self._llm_cache.get(chave)
+            if em_cache is not None:
+                logger.info("Resposta do agente genérico servida do cache")
+                return em_cache
+
+        # astream no lugar do ainvoke bufferizado: os passos do executor
+        # são consumidos conforme ficam prontos, sem esperar o turno
+        # inteiro terminar para começar a montar a resposta
+        pedacos = []
+        async for chunk in self.agent_executor.astream(
+            {"input": message},
+            config={"configurable": {"session_id": user_id}}
+        ):
+            saida = chunk.get("output")
+            if saida:
+                pedacos.append(saida)
+        output = "".join(pedacos) or "Desculpe, não consegui processar sua solicitação."
+
+        if chave is not None:
+            self._llm_cache[chave] = output
+        return output
+
+    async def _llm_path(self, user_id: str, message: str) -> str:
+        """
+        Caminho de interpretação por IA para mensagens sem comando direto
+
+        :param user_id: Identificador da sessão do usuário
+        :param message: Mensagem recebida do usuário
+        :return: Resposta em texto para o usuário
+        """
+        # ETAPA 0: fast path local — comandos bem formados casam na
+        # regex precompilada e nem chegam ao LLM
+        params = self._comando_local(message)
+
+        try:
+            if params is None:
+                # ETAPA 1: extração estruturada da intenção via LLM
+                params = await self._extrair_params_llm(message)
+
+            # Resto do código continua como antes...
+
+            # ETAPA 2: Processar com base na intenção identificada
+            operation_type = params.get("operation_type")
+            sku = params.get("sku")
+
+            # Para consulta de estoque
+            if operation_type == "consultar" and sku:
+                logger.info(f"Consulta de estoque para SKU: {sku}")
+                result = await self._search_tool.run({"sku": sku})
+
+                # Processamento igual ao código existente para consultas
+                try:                        
+                    data = orjson.loads(result)
+                    if data.get("found"):
+                        product = data["product"]
+                        stocks = data.get("stock", [])
+
+                        # Lista + join no lugar de += repetido: a
+                        # resposta cresce linha a linha sem recopiar
+                        # tudo a cada concatenação
+                        partes = [
+                            f"📦 *Produto: {product['name']}*\n",
+                            f"*SKU:* `{product['sku']}`\n\n",
+                        ]
+
+                        # Mostrar estoque do produto atual
+                        partes.append("📊 *Estoque por Depósito:*\n")
+                        if stocks:
+                            for stock in stocks:
+                                warehouse_name = stock.get('warehouse_name', 'Depósito')
+                                quantity = stock.get('quantity', 0)
+                                partes.append(f"• {warehouse_name}: *{quantity}* unidades\n")
+                        else:
+                            partes.append("- Nenhum estoque encontrado para este produto\n")
+
+                        # Mostrar informações do pai e variações se disponíveis
+                        # (mantido igual ao código existente)
+                        if "parent" in data and data["parent"]:
+                            parent = data["parent"]
+                            partes.append(f"\n*Produto Pai:* {parent['name']}\n")
+                            partes.append(f"SKU do Pai: `{parent['sku']}`\n")
+
+                        if "variations" in data and data["variations"]:
+                            partes.append("\n*Variações deste produto:*\n")
+
+                            for i, variation in enumerate(data["variations"], 1):
+                                partes.append(f"{i}. *{variation['name']}*\n")
+                                partes.append(f"   SKU: `{variation['sku']}`\n")
+
+                                if "stock" in variation and variation["stock"]:
+                                    for stock in variation["stock"]:
+                                        warehouse_name = stock.get('warehouse_name', 'Depósito')
+                                        quantity = stock.get('quantity', 0)
+                                        partes.append(f"   - {warehouse_name}: {quantity} unidades\n")
+                                else:
+                                    partes.append("   - Sem estoque disponível\n")
+
+                        return "".join(partes)
+                    else:
+                        return f"❌ Produto com SKU {sku} não encontrado."
+                except orjson.JSONDecodeError:
+                    return "❌ Erro ao processar informações do produto."
+
+            # Para operações que modificam estoque (adicionar, remover, transferir)
+            elif operation_type in ["adicionar", "remover", "transferir", "balanço"] and sku:
+                # Validar o produto antes de preparar a operação
+                product_data = await self._search_tool.run({"sku": sku})
+                product_info = orjson.loads(product_data)
+
+                if not product_info.get("found"):
+                    return f"❌ Produto com SKU {sku} não encontrado. Por favor, verifique o código e tente novamente."
+
+                product = product_info["product"]
+                product_name = product.get("name", "Produto")
+                quantity = params.get("quantity", 1)
+
+                # Preparar os parâmetros para a operação
+                operation_params = {
+                    "sku": sku,
+                    "quantity": quantity,
+                    "operation": operation_type
+                }
+
+                # Adicionar informações de depósito quando aplicável
+                if operation_type == "transferir":
+                    operation_params["warehouse"] = params.get("source_warehouse")
+                    operation_params["target_warehouse"] = params.get("target_warehouse")
+                else:
+                    operation_params["warehouse"] = params.get("source_warehouse")
+
+                logger.info(f"Preparando operação: {operation_params}")
+
+                # Salvar a operação pendente para confirmação
+                # (o TTLCache descarta sozinho depois de 5 minutos)
+                self.conversation_state[user_id] = {
+                    "pending_operation": {
+                        "operation": operation_type,
+                        "sku": sku,
+                        "product_name": product_name,
+                        "quantity": quantity,
+                        "params": operation_params
+                    }
+                }
+
+                # Preparar a mensagem de confirmação personalizada
+                # (mesma tática de lista + join dos outros builders)
+                confirm_partes = [
+                    f"🔍 *Confirmar operação de estoque:*\n\n",
+                    f"• *Operação:* {operation_type}\n",
+                    f"• *Produto:* {product_name}\n",
+                    f"• *SKU:* `{sku}`\n",
+                    f"• *Quantidade:* {quantity} unidades\n",
+                ]
+
+                # Adicionar informações específicas por operação
+                if operation_type == "transferir":
+                    source = params.get("source_warehouse", "Depósito padrão")
+                    target = params.get("target_warehouse", "Depósito destino")
+                    confirm_partes.append(f"• De: {source}\n")
+                    confirm_partes.append(f"• Para: {target}\n")
+                else:
+                    warehouse = params.get("source_warehouse")
+                    if warehouse:
+                        confirm_partes.append(f"• Depósito: {warehouse}\n")
+
+                # Adicionar estoque atual para contexto do usuário
+                confirm_partes.append("\n*Estoque atual:*\n")
+                for stock in product_info.get("stock", []):
+                    warehouse_name = stock.get('warehouse_name', 'Depósito')
+                    current_qty = stock.get('quantity', 0)
+                    confirm_partes.append(f"- {warehouse_name}: {current_qty} unidades\n")
+
+                confirm_partes.append("\n*Para confirmar, responda com \"@confirmar\".*\n")
+                confirm_partes.append("*Para cancelar, responda com \"@cancelar\".*\n")
+                confirm_partes.append("_(Esta operação expira em 5 minutos)_")
+
+                return "".join(confirm_partes)
+
+            # Para outros casos ou se a IA não identificou corretamente
+            else:
+                # Confiança baixa ou operação desconhecida, processar via LLM genérico
+                if params.get("confidence", 0) < 0.7 or operation_type == "outro":
+                    logger.info(f"Baixa confiança ou tipo desconhecido, usando LLM genérico")
+                    # Atualizado para usar o session_id
+                    return await self._agente_generico(user_id, message)
+                else:
+                    return "❓ Não consegui entender o que você deseja fazer com o estoque. Por favor, tente novamente com um comando mais claro."
+
+        except Exception as e:
+            logger.exception(f"Erro ao processar extração: {str(e)}")
+
+            # Fallback para o processamento original - Atualizado para usar o session_id
+            logger.info(f"Usando LLM padrão como fallback")
+            return await self._agente_generico(user_id, message)
+
     async def process_message(self, user_id: str, message: str) -> str:
         """Processa uma mensagem recebida de um usuário"""
+        # Mensagem nova = turno novo: o cache de search_product do turno
+        # anterior não vale mais (o estoque pode ter acabado de mudar)
+        self._turn_cache.clear()
         try:
             # Verificar comandos diretos que não precisam de processamento por IA
-            # No método process_message, na parte que processa a confirmação (~linha 765)
-            
-            # Nesse trecho:
-            if "@confirmar" in message.lower():
+            # Uma única cópia minúscula da mensagem serve todos os branches
+            msg_lower = message.lower()
+
+            # Todo comando direto carrega o sigilo @; a maioria das
+            # mensagens de grupo não carrega e pode pular as regexes de
+            # comando inteiras (a ajuda, que dispensa o @, fica aqui)
+            if "@" not in message:
+                if _CMD_HELP.search(msg_lower):
+                    return _HELP_TEXT
+                return await self._llm_path(user_id, message)
+
+            if _CMD_CONFIRM.search(msg_lower):
                 # Verifica se existe uma operação pendente para este usuário
                 if user_id in self.conversation_state and "pending_operation" in self.conversation_state[user_id]:
                     # Recupera a operação pendente
@@ -809,57 +1636,63 @@ Os nomes das ferramentas são: {tool_names}"""),
                     logger.info(f"Operação pendente recuperada: {operation}")
                     
                     # Executa a operação confirmada
-                    update_tool = self.tools[1]
-                    
-                    # Modificar esta linha:
-                    # Resultado: await update_tool.run(operation["params"])
-                    
-                    # Para:
                     params = operation["params"]
                     if not params.get("warehouse") and params.get("operation") != "transferir":
                         # Se não tem depósito especificado, assume o depósito principal (ID 1511573259)
                         params["warehouse"] = "depósito principal"
                         logger.info("Usando depósito principal como padrão para a operação")
                     
-                    result = await update_tool.run(params)
-                    
+                    result = await self._update_tool.run(params)
+
                     # Limpa o estado
                     del self.conversation_state[user_id]
-                    
+
+                    # A releitura do estoque atualizado já sai disparada aqui,
+                    # em paralelo com o parse do resultado e a montagem da
+                    # resposta — são chamadas independentes entre si
+                    stock_task = asyncio.create_task(self._search_tool.run({"sku": operation["sku"]}))
+
                     # Processamento do resultado igual ao código original...
                     try:
-                        data = json.loads(result)
+                        data = orjson.loads(result)
                         if data.get("success"):
-                            # Prepara a resposta de sucesso
-                            response = f"✅ *Operação realizada com sucesso!*\n\n"
-                            response += f"*Produto:* {operation['product_name']}\n"
-                            response += f"*SKU:* `{operation['sku']}`\n"
-                            response += f"*Operação:* {operation['operation']} {operation['quantity']} unidades\n"
-                            
-                            # Busca os dados atualizados
-                            search_tool = self.tools[0]
-                            new_stock_info = await search_tool.run({"sku": operation["sku"]})
-                            new_data = json.loads(new_stock_info)
-                            
-                            # Mostra o estoque atualizado
-                            response += "\n📊 *Estoque atualizado:*\n"
-                            if new_data.get("found") and new_data.get("stock"):
-                                for stock in new_data["stock"]:
-                                    warehouse_name = stock.get('warehouse_name', 'Depósito')
-                                    quantity = stock.get('quantity', 0)
-                                    response += f"• {warehouse_name}: {quantity} unidades\n"
-                            
-                            return response
+                            # Prepara a resposta de sucesso (lista + join: sem
+                            # realocar a string inteira a cada linha)
+                            partes = [
+                                f"✅ *Operação realizada com sucesso!*\n\n",
+                                f"*Produto:* {operation['product_name']}\n",
+                                f"*SKU:* `{operation['sku']}`\n",
+                                f"*Operação:* {operation['operation']} {operation['quantity']} unidades\n",
+                            ]
+
+                            # Mostra o estoque atualizado (com teto de 5s para a
+                            # releitura não segurar a confirmação já executada)
+                            try:
+                                new_stock_info = await asyncio.wait_for(stock_task, timeout=5.0)
+                                new_data = orjson.loads(new_stock_info)
+
+                                partes.append("\n📊 *Estoque atualizado:*\n")
+                                if new_data.get("found") and new_data.get("stock"):
+                                    for stock in new_data["stock"]:
+                                        warehouse_name = stock.get('warehouse_name', 'Depósito')
+                                        quantity = stock.get('quantity', 0)
+                                        partes.append(f"• {warehouse_name}: {quantity} unidades\n")
+                            except asyncio.TimeoutError:
+                                logger.warning("Releitura do estoque passou de 5s; respondendo sem o saldo atualizado")
+
+                            return "".join(partes)
                         else:
+                            stock_task.cancel()
                             return f"❌ Erro ao executar operação: {data.get('message', 'Erro desconhecido')}"
                     except Exception as e:
+                        stock_task.cancel()
                         logger.error(f"Erro ao processar resultado da operação: {str(e)}")
                         return "❌ Erro ao processar resultado da operação."
                     
                 else:
                     return "❓ Não há operação pendente para confirmar."
             
-            elif "@cancelar" in message.lower():
+            elif _CMD_CANCEL.search(msg_lower):
                 # Código existente para cancelamento...
                 if user_id in self.conversation_state and "pending_operation" in self.conversation_state[user_id]:
                     operation = self.conversation_state[user_id]["pending_operation"]
@@ -873,329 +1706,26 @@ Os nomes das ferramentas são: {tool_names}"""),
                 else:
                     return "❓ Não há operação pendente para cancelar."
             
-                        # Substituir a função de ajuda (~linha 836)
-            
-            elif any(cmd in message.lower() for cmd in ["comandos", "ajuda", "help"]):
+            elif _CMD_HELP.search(msg_lower):
                 # Comando de ajuda solicitado
-                return """📦 *ASSISTENTE DE ESTOQUE - GUIA DE COMANDOS*
-
-Olá! Sou o assistente que gerencia o estoque da Luar Shop. Aqui está tudo que posso fazer:
-
-⚙️ *COMO ME CHAMAR:*
-- Mencione-me diretamente com `@5516993097311` no início da sua mensagem
-
-📊 *OPERAÇÕES DISPONÍVEIS:*
-
-1️⃣ *CONSULTAS DE ESTOQUE*
-  "@mencionar verificar SKU-123"
-  "@mencionar consultar SKU-123"
-  "@mencionar como está o estoque do SKU-123?"
-
-→ _Mostra o nome do produto, quantidade em estoque por depósito e informações de variações/produtos relacionados_
-
-2️⃣ *ADICIONAR ESTOQUE*
-  "@mencionar adicionar 10 unidades do SKU-123"
-  "@mencionar add 5 SKU-456 no depósito principal"
-
-→ _Aumenta o estoque no depósito especificado (ou no Principal se não informado)_
-
-3️⃣ *REMOVER ESTOQUE*
-  "@mencionar remover 3 unidades do SKU-789"
-  "@mencionar baixar 2 SKU-456 do depósito full"
-
-→ _Diminui o estoque do depósito especificado (ou do Principal se não informado)_
-
-4️⃣ *TRANSFERIR ENTRE DEPÓSITOS*
-  "@mencionar transferir 5 SKU-123 do principal para o full"
-  
-→ _Move produtos de um depósito para outro_
-
-5️⃣ *BALANÇO DE ESTOQUE*
-  "@mencionar balanço SKU-123 ajustar para 10 unidades"
-
-→ _Define o estoque para um valor específico (independente do valor atual)_
-
-🏪 *DEPÓSITOS DISPONÍVEIS:*
-- *Depósito Principal* (use "principal" ou "padrão")
-- *Depósito Full* (use "full")
-
-🔐 *PROCESSO DE SEGURANÇA:*
-1. Toda operação que altera estoque exige confirmação
-2. Responda com `@confirmar` para executar ou `@cancelar` para desistir
-3. As operações pendentes expiram após 5 minutos
-
-💡 *DICAS IMPORTANTES:*
-- Use o SKU exato do produto para resultados precisos
-- Para produtos com variações, consulte primeiro o SKU pai
-- Especifique sempre o depósito para evitar erros
-- O sistema funciona apenas em grupos, não em conversas privadas
-- Verifico o estoque antes e depois de cada operação para sua segurança"""
+                return _HELP_TEXT
             
-            # ABORDAGEM INTELIGENTE BASEADA EM IA - Para qualquer outro comando
+            # Para qualquer outro comando com @, cai na abordagem por IA
             else:
-                # ETAPA 1: Usar o LLM para extrair estruturadamente a intenção e parâmetros
-                
-                extraction_prompt = f"""
-                Analise esta mensagem e extraia as informações relevantes para gerenciamento de estoque:
-                "{message}"
-                
-                Responda apenas em formato JSON com as seguintes chaves:
-                {{
-                    "operation_type": "consultar"|"adicionar"|"remover"|"transferir"|"balanço"|"outro",
-                    "sku": "código do produto ou null se não houver",
-                    "quantity": número ou null se não aplicável,
-                    "source_warehouse": "depósito onde a operação será realizada (ou origem no caso de transferência)",
-                    "target_warehouse": "depósito destino (apenas para transferências)",
-                    "confidence": número entre 0 e 1 indicando sua confiança nesta interpretação
-                }}
-                
-                Para operações "adicionar", "remover" ou "balanço", o depósito mencionado deve ser extraído como "source_warehouse".
-                Para "transferir", extraia o depósito de origem como "source_warehouse" e o destino como "target_warehouse".
-                """
-                
-                logger.info(f"Extraindo parâmetros via LLM para a mensagem: '{message}'")
-                
-                # Usar o LLM para extrair parâmetros estruturados
-                extraction_response = await self.llm.ainvoke([
-                    {"role": "system", "content": "Você é um analisador de texto que extrai parâmetros estruturados."},
-                    {"role": "user", "content": extraction_prompt}
-                ])
-                
-                # Extrair o JSON da resposta
-                try:
-                    extracted_text = extraction_response.content
-                    logger.info(f"Texto extraído do LLM: {extracted_text[:100]}...")
-                    
-                    # Verificar se a resposta está vazia
-                    if not extracted_text or extracted_text.isspace():
-                        logger.warning("Resposta de extração vazia, usando fallback")
-                        raise ValueError("Resposta vazia")
-                    
-                    # Limpar o texto para garantir que temos apenas JSON válido
-                    json_text = None
-                    
-                    # Tentar diferentes formatos comuns
-                    if "```json" in extracted_text:
-                        # Formato código markdown
-                        match = re.search(r'```json\s*(.*?)\s*```', extracted_text, re.DOTALL)
-                        if match:
-                            json_text = match.group(1)
-                    elif "```" in extracted_text:
-                        # Outro formato de código sem especificar json
-                        match = re.search(r'```\s*(.*?)\s*```', extracted_text, re.DOTALL)
-                        if match:
-                            json_text = match.group(1)
-                    elif "{" in extracted_text and "}" in extracted_text:
-                        # JSON sem formatação de código
-                        match = re.search(r'\{.*\}', extracted_text, re.DOTALL)
-                        if match:
-                            json_text = match.group(0)
-                    
-                    # Se não conseguiu extrair, usar o texto completo
-                    if not json_text:
-                        json_text = extracted_text.strip()
-                    
-                    logger.info(f"Tentando processar JSON: {json_text[:100]}...")
-                    
-                    # Tentar fazer parse do JSON
-                    try:
-                        params = json.loads(json_text)
-                        logger.info(f"Parâmetros extraídos pela IA: {params}")
-                    except json.JSONDecodeError:
-                        # Se falhar, criar um objeto JSON padrão para indicar baixa confiança
-                        logger.warning("Falha ao decodificar JSON, usando objeto padrão")
-                        params = {
-                            "operation_type": "outro",
-                            "sku": None,
-                            "quantity": None,
-                            "source_warehouse": None,
-                            "target_warehouse": None,
-                            "confidence": 0.1
-                        }
-                    
-                    # Resto do código continua como antes...
-                    
-                    # ETAPA 2: Processar com base na intenção identificada
-                    operation_type = params.get("operation_type")
-                    sku = params.get("sku")
-                    
-                    # Para consulta de estoque
-                    if operation_type == "consultar" and sku:
-                        logger.info(f"Consulta de estoque para SKU: {sku}")
-                        search_tool = self.tools[0]
-                        result = await search_tool.run({"sku": sku})
-                        
-                        # Processamento igual ao código existente para consultas
-                        try:                        
-                            data = json.loads(result)
-                            if data.get("found"):
-                                product = data["product"]
-                                stocks = data.get("stock", [])
-                                
-                                response = f"📦 *Produto: {product['name']}*\n"
-                                response += f"*SKU:* `{product['sku']}`\n\n"
-                                
-                                # Mostrar estoque do produto atual
-                                response += "📊 *Estoque por Depósito:*\n"
-                                if stocks:
-                                    for stock in stocks:
-                                        warehouse_name = stock.get('warehouse_name', 'Depósito')
-                                        quantity = stock.get('quantity', 0)
-                                        response += f"• {warehouse_name}: *{quantity}* unidades\n"
-                                else:
-                                    response += "- Nenhum estoque encontrado para este produto\n"
-                                
-                                # Mostrar informações do pai e variações se disponíveis
-                                # (mantido igual ao código existente)
-                                if "parent" in data and data["parent"]:
-                                    parent = data["parent"]
-                                    response += f"\n*Produto Pai:* {parent['name']}\n"
-                                    response += f"SKU do Pai: `{parent['sku']}`\n"
-                                
-                                if "variations" in data and data["variations"]:
-                                    response += "\n*Variações deste produto:*\n"
-                                    
-                                    for i, variation in enumerate(data["variations"], 1):
-                                        response += f"{i}. *{variation['name']}*\n"
-                                        response += f"   SKU: `{variation['sku']}`\n"
-                                        
-                                        if "stock" in variation and variation["stock"]:
-                                            for stock in variation["stock"]:
-                                                warehouse_name = stock.get('warehouse_name', 'Depósito')
-                                                quantity = stock.get('quantity', 0)
-                                                response += f"   - {warehouse_name}: {quantity} unidades\n"
-                                        else:
-                                            response += "   - Sem estoque disponível\n"
-                                
-                                return response
-                            else:
-                                return f"❌ Produto com SKU {sku} não encontrado."
-                        except json.JSONDecodeError:
-                            return "❌ Erro ao processar informações do produto."
-                    
-                    # Para operações que modificam estoque (adicionar, remover, transferir)
-                    elif operation_type in ["adicionar", "remover", "transferir", "balanço"] and sku:
-                        # Validar o produto antes de preparar a operação
-                        search_tool = self.tools[0]
-                        product_data = await search_tool.run({"sku": sku})
-                        product_info = json.loads(product_data)
-                        
-                        if not product_info.get("found"):
-                            return f"❌ Produto com SKU {sku} não encontrado. Por favor, verifique o código e tente novamente."
-                        
-                        product = product_info["product"]
-                        product_name = product.get("name", "Produto")
-                        quantity = params.get("quantity", 1)
-                        
-                        # Preparar os parâmetros para a operação
-                        operation_params = {
-                            "sku": sku,
-                            "quantity": quantity,
-                            "operation": operation_type
-                        }
-                        
-                        # Adicionar informações de depósito quando aplicável
-                        if operation_type == "transferir":
-                            operation_params["warehouse"] = params.get("source_warehouse")
-                            operation_params["target_warehouse"] = params.get("target_warehouse")
-                        else:
-                            operation_params["warehouse"] = params.get("source_warehouse")
-                        
-                        logger.info(f"Preparando operação: {operation_params}")
-                        
-                        # Salvar a operação pendente para confirmação
-                        self.conversation_state[user_id] = {
-                            "pending_operation": {
-                                "operation": operation_type,
-                                "sku": sku,
-                                "product_name": product_name,
-                                "quantity": quantity,
-                                "params": operation_params,
-                                "timestamp": datetime.now()
-                            }
-                        }
-                        
-                        # Preparar a mensagem de confirmação
-                        # Criar mensagem de confirmação personalizada
-                        confirm_msg = f"🔍 *Confirmar operação de estoque:*\n\n"
-                        confirm_msg += f"• *Operação:* {operation_type}\n"
-                        confirm_msg += f"• *Produto:* {product_name}\n"
-                        confirm_msg += f"• *SKU:* `{sku}`\n"
-                        confirm_msg += f"• *Quantidade:* {quantity} unidades\n"
-                        
-                        # Adicionar informações específicas por operação
-                        if operation_type == "transferir":
-                            source = params.get("source_warehouse", "Depósito padrão")
-                            target = params.get("target_warehouse", "Depósito destino")
-                            confirm_msg += f"• De: {source}\n"
-                            confirm_msg += f"• Para: {target}\n"
-                        else:
-                            warehouse = params.get("source_warehouse")
-                            if warehouse:
-                                confirm_msg += f"• Depósito: {warehouse}\n"
-                        
-                        # Adicionar estoque atual para contexto do usuário
-                        confirm_msg += "\n*Estoque atual:*\n"
-                        for stock in product_info.get("stock", []):
-                            warehouse_name = stock.get('warehouse_name', 'Depósito')
-                            current_qty = stock.get('quantity', 0)
-                            confirm_msg += f"- {warehouse_name}: {current_qty} unidades\n"
-                                
-                        confirm_msg += f"\n*Para confirmar, responda com \"@confirmar\".*\n"
-                        confirm_msg += f"*Para cancelar, responda com \"@cancelar\".*\n"
-                        confirm_msg += f"_(Esta operação expira em 5 minutos)_"
-                        
-                        return confirm_msg
-                    
-                    # Para outros casos ou se a IA não identificou corretamente
-                    else:
-                        # Confiança baixa ou operação desconhecida, processar via LLM genérico
-                        if params.get("confidence", 0) < 0.7 or operation_type == "outro":
-                            logger.info(f"Baixa confiança ou tipo desconhecido, usando LLM genérico")
-                            # Atualizado para usar o session_id
-                            result = await self.agent_executor.ainvoke(
-                                {"input": message},
-                                config={"configurable": {"session_id": user_id}}
-                            )
-                            return result.get("output", "Desculpe, não consegui processar sua solicitação.")
-                        else:
-                            return "❓ Não consegui entender o que você deseja fazer com o estoque. Por favor, tente novamente com um comando mais claro."
-                    
-                except Exception as e:
-                    logger.error(f"Erro ao processar extração: {str(e)}")
-                    import traceback
-                    logger.error(traceback.format_exc())
-                    
-                    # Fallback para o processamento original - Atualizado para usar o session_id
-                    logger.info(f"Usando LLM padrão como fallback")
-                    result = await self.agent_executor.ainvoke(
-                        {"input": message},
-                        config={"configurable": {"session_id": user_id}}
-                    )
-                    return result.get("output", "Desculpe, não consegui processar sua solicitação.")
-                    
+                return await self._llm_path(user_id, message)
+
         except Exception as e:
-            logger.error(f"Erro ao processar mensagem: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.exception(f"Erro ao processar mensagem: {str(e)}")
             return "❌ Desculpe, ocorreu um erro ao processar sua solicitação. Por favor, tente novamente."
                     
     def cleanup_expired_states(self, timeout_minutes: int = 15):
         """
         Limpa estados de conversação expirados
-        
-        :param timeout_minutes: Tempo limite em minutos
+
+        Mantido por compatibilidade com quem agenda a limpeza: o TTLCache
+        já expira cada entrada sozinho, então aqui só forçamos o descarte
+        do que já venceu
+
+        :param timeout_minutes: Ignorado; o TTL é fixado na criação do cache
         """
-        now = datetime.now()
-        expired_users = []
-        
-        for user_id, state in self.conversation_state.items():
-            timestamp = state.get("timestamp", now)
-            if (now - timestamp) > timedelta(minutes=timeout_minutes):
-                expired_users.append(user_id)
-        
-        for user_id in expired_users:
-            del self.conversation_state[user_id]
-        
-        if expired_users:
-            logger.info(f"Limpados {len(expired_users)} estados de conversação expirados")
\ No newline at end of file
+        self.conversation_state.expire()
\ No newline at end of file
@@ -1,18 +1,17 @@
-import json
+import orjson
 import os
+import random
 import time
 import logging
 import asyncio
 import threading
-import requests
-import traceback
-from requests.auth import HTTPBasicAuth
+import httpx
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 from whatsapp_client import create_whatsapp_client, MessageType
 
-# Configuração de logs
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logger do módulo: a configuração do root (handlers, nível) é do main.py
 logger = logging.getLogger("bling_token_manager")
 
 class BlingTokenManager:
@@ -24,7 +23,24 @@ class BlingTokenManager:
     - Mecanismo de recuperação quando o refresh token expira
     """
     
-    def __init__(self, client_id, client_secret, token_file="bling_token.json", env_file=".env", 
+    # Instância compartilhada do processo (ver instance())
+    _instance = None
+
+    @classmethod
+    def instance(cls, **kwargs):
+        """
+        Singleton do gerenciador: a primeira chamada constrói a instância
+        com os parâmetros dados; as seguintes devolvem a mesma. Garante um
+        único pipeline de refresh e um único dono do arquivo de token —
+        dois managers disputariam o refresh_token de uso único do Bling.
+        :param kwargs: Parâmetros do construtor (usados só na primeira vez)
+        :return: Instância compartilhada do BlingTokenManager
+        """
+        if cls._instance is None:
+            cls._instance = cls(**kwargs)
+        return cls._instance
+
+    def __init__(self, client_id, client_secret, token_file="bling_token.json", env_file=".env",
                  auth_callback_url=None, webhook_url=None, whatsapp_config=None, admin_phone=None):
         """
         Inicializa o gerenciador de tokens
@@ -67,6 +83,15 @@ class BlingTokenManager:
         # Dados do token em memória
         self._token_data = None
         self._token_lock = threading.Lock()
+
+        # Cliente HTTP assíncrono compartilhado: antes cada renovação usava
+        # requests síncrono, bloqueando o event loop e refazendo TCP + TLS
+        self._http = None
+        self._owns_http = True  # Falso quando o app injeta o cliente dele
+
+        # Renovação em voo (single-flight): chamadas simultâneas aguardam a
+        # mesma task em vez de disparar refreshes concorrentes
+        self._refresh_task = None
         
         # Carrega token do arquivo, se existir
         self._load_token()
@@ -77,6 +102,32 @@ class BlingTokenManager:
         
         logger.info("Gerenciador de token Bling inicializado")
     
+    def _get_http(self):
+        """
+        Retorna o cliente HTTP assíncrono compartilhado, criando-o na
+        primeira chamada (precisa nascer com o event loop ativo)
+        :return: httpx.AsyncClient com pool keep-alive
+        """
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(timeout=30.0)
+            self._owns_http = True
+        return self._http
+
+    def adopt_http_client(self, client):
+        """
+        Passa a usar um cliente HTTP compartilhado de fora (ex.: o
+        app.state.http do FastAPI) — um pool único para o processo inteiro.
+        O ciclo de vida do cliente fica com quem o criou
+        :param client: httpx.AsyncClient compartilhado
+        """
+        self._http = client
+        self._owns_http = False
+
+    async def aclose(self):
+        """Fecha o cliente HTTP compartilhado, se for nosso (usar no shutdown)"""
+        if self._owns_http and self._http and not self._http.is_closed:
+            await self._http.aclose()
+
      # Modifique o método _load_token no token_manager.py
     def _load_token(self):
         """Carrega os dados do token do arquivo com verificação de timestamp futuro"""
@@ -85,8 +136,9 @@ class BlingTokenManager:
                 # Armazena o timestamp de modificação
                 self._last_token_mtime = os.path.getmtime(self.token_file)
                 
-                with open(self.token_file, "r") as file:
-                    self._token_data = json.load(file)
+                # orjson decodifica direto dos bytes (parser em C)
+                with open(self.token_file, "rb") as file:
+                    self._token_data = orjson.loads(file.read())
                 logger.info("Token carregado do arquivo")
                 
                 # NOVA VERIFICAÇÃO: Se created_at está no futuro, corrige para o timestamp atual
@@ -129,9 +181,14 @@ class BlingTokenManager:
         """Salva os dados do token no arquivo"""
         try:
             with self._token_lock:
-                with open(self.token_file, "w") as file:
-                    json.dump(self._token_data, file, indent=2)
-                
+                # Escrita atômica: grava tudo em um temporário e troca com
+                # os.replace — uma queda no meio nunca deixa o arquivo de
+                # token truncado
+                tmp_file = f"{self.token_file}.tmp"
+                with open(tmp_file, "wb") as file:
+                    file.write(orjson.dumps(self._token_data, option=orjson.OPT_INDENT_2))
+                os.replace(tmp_file, self.token_file)
+
                 # Atualiza o arquivo .env
                 self._update_env_file()
                 
@@ -188,10 +245,14 @@ class BlingTokenManager:
                 updated_lines.append(f"\n# Token Bling gerado em {current_time}\n")
                 updated_lines.append(f"BLING_API_KEY={access_token}\n")
             
-            # Escreve o arquivo atualizado
-            with open(self.env_file, "w") as env_file:
-                env_file.writelines(updated_lines)
-            
+            # Escreve o arquivo atualizado de forma atômica: conteúdo
+            # montado em memória, um único write e os.replace no lugar da
+            # reescrita direta (sem risco de .env truncado em caso de queda)
+            tmp_env = f"{self.env_file}.tmp"
+            with open(tmp_env, "w") as env_file:
+                env_file.write("".join(updated_lines))
+            os.replace(tmp_env, self.env_file)
+
             # Também atualiza a variável de ambiente atual
             os.environ["BLING_API_KEY"] = access_token
             
@@ -291,23 +352,24 @@ class BlingTokenManager:
             }
             
             # Autenticação HTTP Basic
-            auth = HTTPBasicAuth(self.client_id, self.client_secret)
-            
+            auth = (self.client_id, self.client_secret)
+
             # NOVO: Implementa retry para problemas de conexão
             for attempt in range(3):  # 3 tentativas
                 try:
-                    # Faz a requisição com timeout maior
-                    response = requests.post(
+                    # Requisição assíncrona pelo pool compartilhado: não
+                    # bloqueia o event loop durante o round-trip
+                    response = await self._get_http().post(
                         self.token_url,
                         data=payload,
                         headers=headers,
                         auth=auth,
                         timeout=30  # Timeout aumentado
                     )
-                    
+
                     # Se conseguiu resposta, sai do loop
                     break
-                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                except (httpx.TimeoutException, httpx.TransportError) as e:
                     logger.warning(f"Erro de conexão na tentativa {attempt+1}/3: {str(e)}")
                     if attempt < 2:  # Se não for a última tentativa
                         await asyncio.sleep(2 * (attempt + 1))  # Backoff progressivo: 2s, 4s
@@ -324,8 +386,9 @@ class BlingTokenManager:
                 with self._token_lock:
                     self._token_data = new_token_data
                 
-                # Salva o token
-                self._save_token()
+                # Salva o token fora do event loop (write + os.replace
+                # são syscalls bloqueantes)
+                await asyncio.to_thread(self._save_token)
                 
                 logger.info(f"Token renovado com sucesso, expira em {new_token_data.get('expires_in', 'N/A')} segundos")
                 return True
@@ -377,9 +440,8 @@ class BlingTokenManager:
                 return False
                 
         except Exception as e:
-            logger.error(f"Erro durante renovação do token: {str(e)}")
-            logger.error(traceback.format_exc())
-            
+            logger.exception(f"Erro durante renovação do token: {str(e)}")
+
             # Incrementa contador de falhas
             self.consecutive_failures += 1
             self.last_error_time = datetime.now()
@@ -422,7 +484,7 @@ class BlingTokenManager:
                 }
                 
                 # Envia requisição para o webhook
-                webhook_response = requests.post(
+                webhook_response = await self._get_http().post(
                     self.webhook_url,
                     json=webhook_data,
                     headers={"Content-Type": "application/json"},
@@ -530,12 +592,20 @@ class BlingTokenManager:
         :return: URL de autorização
         """
         base_url = "https://www.bling.com.br/Api/v3/oauth/authorize"
-        redirect_uri = self.auth_callback_url or "https://estoqueml.luarshop.com.br/callback"
-        
-        auth_url = (
-            f"{base_url}?response_type=code&client_id={self.client_id}"
-            f"&redirect_uri={redirect_uri}&scope=abilitado&state=autorizacao"
-        )
+        redirect_uri = self.auth_callback_url or ""
+        if not redirect_uri:
+            logger.warning("BLING_CALLBACK_URL não configurada; a URL de autorização ficará sem redirect_uri válido")
+
+        # urlencode percent-encoda os valores (o redirect_uri tem :// e /)
+        # e monta a query em C, em vez de concatenar f-strings sem escape
+        query = urlencode({
+            "response_type": "code",
+            "client_id": self.client_id,
+            "redirect_uri": redirect_uri,
+            "scope": "abilitado",
+            "state": "autorizacao",
+        })
+        auth_url = f"{base_url}?{query}"
         
         return auth_url
     
@@ -573,6 +643,46 @@ class BlingTokenManager:
             logger.debug(f"Token válido por mais {remaining_seconds:.1f} segundos")
             return False
         
+    def _seconds_until_expiry(self):
+        """
+        Segundos restantes até o token atual expirar
+        :return: Tempo restante em segundos (0 se desconhecido/expirado)
+        """
+        if not self._token_data:
+            return 0
+        if "expires_in" not in self._token_data or "created_at" not in self._token_data:
+            return 0
+
+        expiry_timestamp = self._token_data["created_at"] + self._token_data["expires_in"]
+        return max(expiry_timestamp - datetime.now().timestamp(), 0)
+
+    def _token_state(self, stale_seconds=300):
+        """
+        Classifica o token atual em três estados:
+        - FRESH: válido, usa direto
+        - STALE: perto de expirar; ainda serve, mas renova em segundo plano
+        - EXPIRED: expirado (ou inexistente); precisa renovar antes de usar
+        :param stale_seconds: Janela antes da expiração considerada "stale"
+        :return: 'FRESH', 'STALE' ou 'EXPIRED'
+        """
+        restante = self._seconds_until_expiry()
+        if restante <= 0:
+            return 'EXPIRED'
+        if restante <= stale_seconds:
+            return 'STALE'
+        return 'FRESH'
+
+    async def _refresh_once(self):
+        """
+        Renovação single-flight: se já há um refresh em andamento, aguarda
+        o resultado dele em vez de abrir outro (evita estouro de quota e
+        corrida no refresh_token, que é de uso único no Bling)
+        :return: True se renovado com sucesso, False caso contrário
+        """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh_token())
+        return await self._refresh_task
+
     async def _try_client_credentials(self):
         """
         Tenta recuperar um token usando client_credentials quando o refresh_token falha
@@ -589,16 +699,16 @@ class BlingTokenManager:
             
             # Prepara a requisição
             headers = {"Content-Type": "application/x-www-form-urlencoded"}
-            auth = HTTPBasicAuth(self.client_id, self.client_secret)
-            
+            auth = (self.client_id, self.client_secret)
+
             # O Bling aceita client_credentials com os escopos apropriados
             payload = {
                 "grant_type": "client_credentials",
                 "scope": "Api.Estoque Api.Produtos"  # Escopos essenciais para consulta de produtos
             }
-            
+
             # Faz a requisição
-            response = requests.post(
+            response = await self._get_http().post(
                 self.token_url,
                 headers=headers,
                 auth=auth,
@@ -615,8 +725,9 @@ class BlingTokenManager:
                 with self._token_lock:
                     self._token_data = new_token_data
                 
-                # Salva o token
-                self._save_token()
+                # Salva o token fora do event loop (write + os.replace
+                # são syscalls bloqueantes)
+                await asyncio.to_thread(self._save_token)
                 
                 logger.info(f"✅ Token obtido com sucesso via client_credentials. Válido por {new_token_data.get('expires_in', 0) / 3600:.1f} horas")
                 return True
@@ -633,10 +744,8 @@ class BlingTokenManager:
                 return False
                 
         except Exception as e:
-            logger.error(f"❌ Erro durante recuperação com client_credentials: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
-            return False    
+            logger.exception(f"❌ Erro durante recuperação com client_credentials: {str(e)}")
+            return False
     
     async def get_valid_token(self):
         """
@@ -671,29 +780,28 @@ class BlingTokenManager:
                         return self._token_data.get("access_token")
                     return None
                 
-                # Verifica se o token está expirado ou prestes a expirar
-                needs_renewal = self._is_token_expired_or_expiring_soon()
-                
-            # Tenta renovar o token se necessário
-            if needs_renewal:
-                logger.info("Token expirado ou prestes a expirar, renovando...")
-                success = await self.refresh_token()
+                # Classifica o token: FRESH / STALE / EXPIRED
+                estado = self._token_state()
+
+            if estado == 'STALE':
+                # Janela stale: serve o token atual imediatamente e dispara
+                # a renovação em segundo plano — nenhum chamador paga a
+                # latência do round-trip de OAuth
+                logger.info("Token perto de expirar, renovando em segundo plano")
+                if self._refresh_task is None or self._refresh_task.done():
+                    self._refresh_task = asyncio.create_task(self.refresh_token())
+            elif estado == 'EXPIRED':
+                # Só aqui o chamador bloqueia, e todos os simultâneos
+                # aguardam o mesmo refresh em voo
+                logger.info("Token expirado, renovando...")
+                success = await self._refresh_once()
                 if not success:
-                    logger.warning("Falha ao renovar token automaticamente")
-                    
-                    # Se o token ainda é válido (apenas prestes a expirar), podemos usá-lo
-                    with self._token_lock:
-                        if self._token_data and "access_token" in self._token_data:
-                            if not self._is_token_expired_or_expiring_soon(threshold_seconds=0):  # Verifica se já expirou
-                                logger.info("Usando token atual mesmo prestes a expirar")
-                                return self._token_data.get("access_token")
-                            else:
-                                logger.error("Token expirado e falha na renovação")
-                                # NOVO: Tenta uma última vez com client_credentials
-                                success = await self._try_client_credentials()
-                                if success:
-                                    return self._token_data.get("access_token")
-                                return None
+                    logger.error("Token expirado e falha na renovação")
+                    # NOVO: Tenta uma última vez com client_credentials
+                    success = await self._try_client_credentials()
+                    if success:
+                        return self._token_data.get("access_token")
+                    return None
             
             # Retorna o token atual (renovado ou não)
             with self._token_lock:
@@ -705,8 +813,7 @@ class BlingTokenManager:
                 return token
                 
         except Exception as e:
-            logger.error(f"Erro ao obter token válido: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Erro ao obter token válido: {str(e)}")
             # Em caso de erro, tenta recuperação
             self.consecutive_failures += 1
             await self._attempt_token_recovery()
@@ -728,50 +835,60 @@ class BlingTokenManager:
     
     def start_renewal_job(self, interval_hours=1):
         """Versão melhorada do início do job de renovação"""
-        if self._renewal_running:
+        # Guarda idempotente na própria task: chamadas repetidas devolvem o
+        # job que já roda em vez de cancelar/recriar (ou criar um segundo)
+        if self._renewal_task and not self._renewal_task.done():
             logger.info("Job de renovação já está em execução")
-            return
-        
-        # Cancela qualquer tarefa anterior
-        if hasattr(self, '_renewal_task') and self._renewal_task:
-            self._renewal_task.cancel()
-        
+            return self._renewal_task
+
         self._renewal_running = True
         
         async def renewal_job():
             """Job assíncrono para renovação periódica com verificação de saúde"""
             logger.info(f"Iniciando job de renovação com verificação a cada {interval_hours} horas")
-            
+
             # Verificação imediata na inicialização
             await self._renew_if_needed()
-            
+
+            job_failures = 0  # Erros consecutivos do loop (backoff exponencial)
+
             while self._renewal_running:
                 try:
-                    # Intervalo mais curto para verificação mais frequente
-                    check_interval = 15 * 60  # 15 minutos
-                    
-                    # Dividir o tempo de espera em intervalos menores
-                    # para que possamos verificar self._renewal_running com mais frequência
-                    chunks = int((interval_hours * 3600) / check_interval)
-                    
-                    for _ in range(chunks):
-                        if not self._renewal_running:
-                            break
-                        await asyncio.sleep(check_interval)
-                        # Verificação periódica durante o intervalo
-                        await self._renew_if_needed()
-                    
+                    # Intervalo adaptativo: quanto mais perto da expiração,
+                    # mais frequente a checagem (1/4 do tempo restante,
+                    # entre 5 minutos e 1 hora). Token novo = poucas
+                    # chamadas; token velho = detecção rápida
+                    restante = self._seconds_until_expiry()
+                    check_interval = min(max(restante / 4, 300), 3600)
+
+                    # Jitter de ±5% no intervalo: espalha as checagens
+                    # em vez de acertar sempre o mesmo minuto da hora
+                    await asyncio.sleep(
+                        check_interval * random.uniform(0.95, 1.05)
+                    )
+                    # Verificação periódica durante o intervalo
+                    await self._renew_if_needed()
+
+                    # Ciclo completo sem erro: zera o backoff
+                    job_failures = 0
+
                 except asyncio.CancelledError:
                     logger.info("Job de renovação cancelado")
                     break
                 except Exception as e:
-                    logger.error(f"Erro no job de renovação: {str(e)}")
-                    # Continua tentando após erro (com tempo reduzido)
-                    await asyncio.sleep(60)
+                    # Backoff exponencial com jitter: 60s, 120s, 240s...
+                    # até 30 min, evitando martelar o Bling durante quedas
+                    job_failures += 1
+                    delay = min(60 * (2 ** (job_failures - 1)), 1800)
+                    delay += random.uniform(-0.1, 0.1) * delay
+                    logger.error(f"Erro no job de renovação (falha #{job_failures}): {str(e)}")
+                    logger.info(f"Nova tentativa em {delay:.0f}s")
+                    await asyncio.sleep(delay)
         
         # Mantém referência à tarefa e adiciona nome para depuração
-        loop = asyncio.get_event_loop()
-        self._renewal_task = loop.create_task(renewal_job())
+        # (asyncio.create_task agenda no loop em execução, sem o caminho
+        # deprecado do get_event_loop)
+        self._renewal_task = asyncio.create_task(renewal_job())
         self._renewal_task.set_name("token_renewal_job")
         logger.info("Job de renovação iniciado com verificações a cada 15 minutos")
         
@@ -818,10 +935,10 @@ class BlingTokenManager:
             }
             
             # Autenticação HTTP Basic
-            auth = HTTPBasicAuth(self.client_id, self.client_secret)
-            
+            auth = (self.client_id, self.client_secret)
+
             # Faz a requisição
-            response = requests.post(
+            response = await self._get_http().post(
                 self.token_url,
                 data=payload,
                 headers=headers,
@@ -838,8 +955,9 @@ class BlingTokenManager:
                 with self._token_lock:
                     self._token_data = token_data
                 
-                # Salva o token
-                self._save_token()
+                # Salva o token fora do event loop (write + os.replace
+                # são syscalls bloqueantes)
+                await asyncio.to_thread(self._save_token)
                 
                 # Reset dos estados de erro
                 self.error_state = False
@@ -1,7 +1,7 @@
 # whatsapp_client.py
 import logging
 import aiohttp
-import json
+import orjson
 from enum import Enum
 from typing import Dict, Any, Optional
 
@@ -30,8 +30,40 @@ class WhatsAppClient:
             instance = instance.split('#')[0].strip()
         
         self.instance = instance
+        # Sessão compartilhada entre envios: reaproveita o pool de conexões
+        # e o keep-alive em vez de refazer TCP + TLS + DNS a cada mensagem
+        self._session: Optional[aiohttp.ClientSession] = None
         logger.info(f"Cliente WhatsApp inicializado para instância limpa: '{self.instance}'")
-    
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Retorna a sessão HTTP compartilhada, criando-a no primeiro envio
+        (precisa nascer dentro do event loop, por isso não vai no __init__)
+        :return: Sessão aiohttp reutilizável
+        """
+        if self._session is None or self._session.closed:
+            # Pool ajustado: mais slots por host para rajadas de alertas,
+            # cache de DNS e limpeza de conexões TLS fechadas
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                enable_cleanup_closed=True,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                # orjson serializa o payload em C (bytes -> decode p/ str)
+                json_serialize=lambda obj: orjson.dumps(obj).decode()
+            )
+        return self._session
+
+    async def close(self):
+        """Fecha a sessão HTTP compartilhada (usar no shutdown)"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
     async def send_message(self, text: str, number: str, message_type: MessageType = MessageType.TEXT, 
                          simulate_typing: bool = True, delay: int = 1000, 
                          metadata: Optional[Dict[str, Any]] = None) -> bool:
@@ -74,29 +106,31 @@ class WhatsAppClient:
                 logger.info(f"Enviando mensagem para: {number} (Grupo: {is_group})")
                 logger.info(f"Endpoint: {endpoint}")
                 
-                # Realiza a requisição HTTP
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        endpoint,
-                        headers=headers,
-                        json=payload
-                    ) as response:
-                        status_code = response.status
-                        response_text = await response.text()
-                        
-                        try:
-                            response_data = json.loads(response_text)
-                            
-                            if status_code == 200 or status_code == 201:
-                                logger.info(f"Mensagem enviada com sucesso: {status_code}")
-                                return True
-                            else:
-                                logger.error(f"Erro ao enviar mensagem: {status_code}")
-                                logger.error(f"Resposta: {json.dumps(response_data, indent=2)}")
-                                return False
-                        except:
-                            logger.error(f"Resposta não-JSON: {response_text}")
+                # Realiza a requisição HTTP pela sessão compartilhada
+                session = self._get_session()
+                async with session.post(
+                    endpoint,
+                    headers=headers,
+                    json=payload
+                ) as response:
+                    status_code = response.status
+                    response_body = await response.read()
+
+                    try:
+                        # orjson decodifica direto dos bytes, sem passar
+                        # pelo json da stdlib nem decodificar texto antes
+                        response_data = orjson.loads(response_body)
+
+                        if status_code == 200 or status_code == 201:
+                            logger.info(f"Mensagem enviada com sucesso: {status_code}")
+                            return True
+                        else:
+                            logger.error(f"Erro ao enviar mensagem: {status_code}")
+                            logger.error(f"Resposta: {orjson.dumps(response_data, option=orjson.OPT_INDENT_2).decode()}")
                             return False
+                    except:
+                        logger.error(f"Resposta não-JSON: {response_body.decode('utf-8', errors='replace')}")
+                        return False
             else:
                 logger.error(f"Tipo de mensagem não suportado: {message_type}")
                 return False